@@ -0,0 +1,405 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from keyring_database import KeyringDB, HashEntry, KeyFilter, CREATED_FORMAT  # noqa: E402
+from console_config import console  # noqa: E402
+import ciphers  # noqa: E402
+import hashing  # noqa: E402
+
+# Benchmark harness for the cipher, KDF and keyring hot paths.
+#
+# Every case runs in a forked child so its peak RSS is its own, and reports
+# p50/p99 latency over its repetitions plus throughput. Results are written
+# as JSON and can be compared against a stored baseline:
+#
+#   python3 bench/bench.py --output bench.json
+#   python3 bench/bench.py --baseline bench.json --tolerance 0.15
+#
+# The startup suite runs scripted CLI commands in fresh interpreters under
+# -X importtime and fails if they load any of the interactive UI modules.
+DEFAULT_SIZES = "1K,1M,64M,1G"
+DEFAULT_ROWS = "10,10000,1000000"
+DEFAULT_KDF_REPEAT = 10
+DEFAULT_TOLERANCE = 0.10
+BLOCK_SIZE = 1024 * 1024
+
+# Processes and bytes per cipher case are capped so small sizes still run
+# long enough to time and large ones finish
+CIPHER_TARGET_BYTES = 256 * 1024 * 1024
+CIPHER_MAX_REPEAT = 200
+
+# Rows inserted per executemany when filling the keyring
+FILL_BATCH = 10000
+
+# Rendering every row through Rich takes seconds per 10k rows, so dump_keys
+# only runs on keyrings up to this size and a few times
+DUMP_MAX_ROWS = 10000
+DUMP_REPEAT = 3
+
+# A valid Argon2id hash of "benchmark" with small parameters, so filling a
+# large keyring doesn't run the KDF per row
+FILL_HASH = "$argon2id$v=19$m=8,t=1,p=1$YmVuY2htYXJrc2FsdDEyMw$rr+GpCjDGPdz6tWBFLJC/4EsajX5h9dAYAIv9jfzGLg"
+
+# Startup runs per command, modules only the interactive menus need and
+# modules only commands that hash or verify a passphrase need
+STARTUP_REPEAT = 20
+UI_MODULES = ("menus", "rich", "asyncio")
+KDF_MODULES = ("argon2",)
+CLI_PATH = Path(__file__).resolve().parent.parent / "src" / "cli.py"
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    if value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+
+    return int(value)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(name: str, params: dict, samples: list, work: int, unit: str) -> dict:
+    # work is the amount handled per repetition, in bytes or operations
+    total = sum(samples)
+    return {
+        "name": name,
+        "params": params,
+        "repeat": len(samples),
+        "p50": percentile(samples, 0.50),
+        "p99": percentile(samples, 0.99),
+        "mean": total / len(samples),
+        "throughput": work * len(samples) / total if total else 0.0,
+        "unit": unit,
+    }
+
+
+def timed(fn, repeat: int) -> list:
+    samples = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def run_isolated(case, *args) -> dict:
+    # Fork, run the case and ship back its result with the child's peak RSS
+    parent, child = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        result = case(*args)
+        result["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        child.send(result)
+
+    process = multiprocessing.get_context("fork").Process(target=target)
+    process.start()
+    result = parent.recv()
+    process.join()
+
+    return result
+
+
+def write_file(path: Path, size: int):
+    block = os.urandom(BLOCK_SIZE)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:min(remaining, BLOCK_SIZE)])
+            remaining -= BLOCK_SIZE
+
+
+def cipher_cases(workdir: Path, sizes: list) -> list:
+    key = os.urandom(32)
+    results = list()
+    for size in sizes:
+        plain = workdir / "plain"
+        sealed = workdir / "sealed"
+        opened = workdir / "opened"
+        write_file(plain, size)
+        repeat = max(1, min(CIPHER_MAX_REPEAT, CIPHER_TARGET_BYTES // max(size, 1)))
+
+        def encrypt_case():
+            samples = timed(lambda: ciphers.encrypt_file(plain, key, sealed), repeat)
+            return summarize("cipher.encrypt", {"size": size}, samples, size, "B/s")
+
+        def decrypt_case():
+            samples = timed(lambda: ciphers.decrypt_file(sealed, key, opened), repeat)
+            return summarize("cipher.decrypt", {"size": size}, samples, size, "B/s")
+
+        results.append(run_isolated(encrypt_case))
+        results.append(run_isolated(decrypt_case))
+        for path in (plain, sealed, opened):
+            path.unlink(missing_ok=True)
+
+    return results
+
+
+def kdf_cases(repeat: int) -> list:
+    argon2_hash = hashing.hash_passphrase("benchmark")
+    params = asdict(hashing.current_params())
+
+    def hash_case():
+        samples = timed(lambda: hashing.hash_passphrase("benchmark"), repeat)
+        return summarize("kdf.hash_passphrase", params, samples, 1, "op/s")
+
+    def verify_case():
+        samples = timed(lambda: hashing.verify(argon2_hash, "benchmark"), repeat)
+        return summarize("kdf.verify", params, samples, 1, "op/s")
+
+    return [run_isolated(hash_case), run_isolated(verify_case)]
+
+
+def fill_keyring(keyring_db: KeyringDB, rows: int):
+    created = datetime.now().strftime(CREATED_FORMAT)
+    with keyring_db.lock, keyring_db.connect() as conn:
+        for start in range(0, rows, FILL_BATCH):
+            count = min(FILL_BATCH, rows - start)
+            conn.executemany(
+                "INSERT INTO keyring (created, comments, hash, created_at, argon_variant, "
+                "memory_cost, time_cost, parallelism) VALUES(?, ?, ?, ?, 'argon2id', 8, 1, 1)",
+                ((created, "entry " + str(start + i), FILL_HASH, int(time.time()))
+                 for i in range(count)))
+
+
+def keyring_cases(workdir: Path, row_counts: list) -> list:
+    results = list()
+    for rows in row_counts:
+        db_path = workdir / ("keyring-" + str(rows))
+        with KeyringDB(db_path) as keyring_db:
+            keyring_db.initial_setup()
+            fill_keyring(keyring_db, rows)
+        middle = rows // 2 + 1
+        # Point operations repeat enough to get a p99, full scans fewer times
+        point = 200
+        scan = max(1, min(20, 1000000 // rows))
+
+        operations = (
+            ("keyring.get_valid_ids", scan, lambda db: db.get_valid_ids()),
+            ("keyring.iter_keys", scan, lambda db: sum(1 for _ in db.iter_keys())),
+            ("keyring.dump_keys", DUMP_REPEAT if rows <= DUMP_MAX_ROWS else 0,
+             lambda db: db.dump_keys()),
+            ("keyring.list_keys", point, lambda db: db.list_keys(middle)),
+            ("keyring.list_keys_filtered", point,
+             lambda db: db.list_keys(0, 100, KeyFilter(comment="entry 1"))),
+            ("keyring.key_exists", point, lambda db: db.key_exists(middle)),
+            ("keyring.has_keys", point, lambda db: db.has_keys()),
+            ("keyring.fetch_hash", point, lambda db: db.fetch_hash(middle)),
+            ("keyring.unlock_hash", point, lambda db: db.unlock_hash(middle, "benchmark")),
+            ("keyring.edit_comments", point, lambda db: db.edit_comments(["edited", middle])),
+            ("keyring.store_hash", point,
+             lambda db: db.store_hash(HashEntry("01-01-26 00:00:00", "bench", FILL_HASH))),
+            # Deletes the oldest row each time, store_hash above adds enough
+            ("keyring.delete_hash", point, lambda db: db.delete_hash(db.list_keys(0, 1)[0][0])),
+        )
+
+        for name, repeat, operation in operations:
+            if repeat == 0:
+                continue
+
+            def case(name=name, repeat=repeat, operation=operation):
+                # Rendering goes to a throwaway file so dump_keys measures
+                # query and table building, not the terminal
+                console.file = open(os.devnull, "w")
+                with KeyringDB(db_path) as keyring_db:
+                    operation(keyring_db)
+                    samples = timed(lambda: operation(keyring_db), repeat)
+                return summarize(name, {"rows": rows}, samples, 1, "op/s")
+
+            results.append(run_isolated(case))
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(db_path) + suffix).unlink(missing_ok=True)
+
+    return results
+
+
+def import_times(argv: list, env: dict) -> dict:
+    # Cumulative import time in microseconds of every module a CLI run loads
+    completed = subprocess.run([sys.executable, "-X", "importtime", str(CLI_PATH)] + argv,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               text=True)
+    if completed.returncode != 0:
+        raise RuntimeError("lockbox " + " ".join(argv) + " failed:\n" + completed.stderr[-2000:])
+    times = dict()
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+# Runs the CLI in the child and reports its VmHWM on exit
+RSS_PROBE = """
+import atexit, os, runpy, sys
+fd = int(sys.argv[1])
+def report():
+    with open("/proc/self/status") as f:
+        peak = [line.split()[1] for line in f if line.startswith("VmHWM:")]
+    os.write(fd, peak[0].encode())
+atexit.register(report)
+sys.path.insert(0, os.path.dirname(sys.argv[2]))
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def peak_rss(argv: list, env: dict) -> int:
+    # Peak RSS in KiB of one CLI run. ru_maxrss can't tell: Linux carries
+    # the parent's high-water mark into children across fork and exec, so
+    # every child reports at least this benchmark's own RSS
+    read_fd, write_fd = os.pipe()
+    try:
+        subprocess.run([sys.executable, "-c", RSS_PROBE, str(write_fd), str(CLI_PATH)] + argv,
+                       env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       pass_fds=(write_fd,))
+        os.close(write_fd)
+        write_fd = None
+        peak = os.read(read_fd, 64)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+
+    return int(peak) if peak else 0
+
+
+def startup_cases(workdir: Path) -> list:
+    db_path = workdir / "keyring-startup"
+    with KeyringDB(db_path) as keyring_db:
+        keyring_db.initial_setup()
+        fill_keyring(keyring_db, 1)
+    plain = workdir / "plain"
+    sealed = workdir / "sealed"
+    write_file(plain, 1024)
+    key = ciphers.derive_key(hashing.parse_argon2_hash(FILL_HASH).digest)
+    ciphers.encrypt_file(plain, key, sealed)
+
+    env = dict(os.environ, LOCKBOX_BENCH_PASS="benchmark")
+    common = ["--db", str(db_path), "--params", str(workdir / "argon2.json")]
+    commands = (
+        ("decrypt", ["decrypt", str(sealed), str(workdir / "opened"), "-k", "1",
+                     "--passphrase-env", "LOCKBOX_BENCH_PASS"], UI_MODULES),
+        ("keys_list", ["keys", "list", "--json"], UI_MODULES + KDF_MODULES),
+        ("help", ["--help"], UI_MODULES + KDF_MODULES),
+    )
+
+    results = list()
+    for name, argv, forbidden in commands:
+        times = import_times(common + argv, env)
+        samples = timed(lambda: subprocess.run(
+            [sys.executable, str(CLI_PATH)] + common + argv, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), STARTUP_REPEAT)
+        result = summarize("startup." + name, {"command": name}, samples, 1, "run/s")
+        result["import_us"] = times.get("commands", 0) + times.get("menus", 0)
+        result["forbidden_modules"] = sorted(module for module in times
+                                             if module.split(".")[0] in forbidden)
+        result["peak_rss_kib"] = peak_rss(common + argv, env)
+        results.append(result)
+
+    return results
+
+
+def case_key(result: dict) -> str:
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    # A case regresses when its median latency grows by more than tolerance
+    previous = {case_key(result): result for result in baseline}
+    regressions = list()
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is not None and result["p50"] > old["p50"] * (1 + tolerance):
+            regressions.append((result, old))
+
+    return regressions
+
+
+def print_results(results: list):
+    for result in results:
+        params = ",".join(k + "=" + str(v) for k, v in result["params"].items())
+        print("{:<28} {:<40} p50 {:>10.3f} ms  p99 {:>10.3f} ms  {:>14.1f} {}  rss {} KiB".format(
+            result["name"], params, result["p50"] * 1000, result["p99"] * 1000,
+            result["throughput"], result["unit"], result["peak_rss_kib"]))
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark lockbox hot paths")
+    parser.add_argument("--suites", default="cipher,kdf,keyring,startup",
+                        help="comma separated suites to run")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="file sizes for the cipher suite, e.g. 1K,1M,4G")
+    parser.add_argument("--rows", default=DEFAULT_ROWS,
+                        help="keyring sizes for the keyring suite")
+    parser.add_argument("--kdf-repeat", type=int, default=DEFAULT_KDF_REPEAT)
+    parser.add_argument("--workdir", type=Path, help="directory for temporary files")
+    parser.add_argument("--output", type=Path, help="write results as JSON")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown of p50 before a case counts as a regression")
+    args = parser.parse_args(argv)
+    suites = args.suites.split(",")
+
+    results = list()
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        if "cipher" in suites:
+            sizes = [parse_size(size) for size in args.sizes.split(",")]
+            results += cipher_cases(Path(workdir), sizes)
+        if "kdf" in suites:
+            results += kdf_cases(args.kdf_repeat)
+        if "keyring" in suites:
+            row_counts = [parse_size(rows) for rows in args.rows.split(",")]
+            results += keyring_cases(Path(workdir), row_counts)
+        if "startup" in suites:
+            results += startup_cases(Path(workdir))
+
+    print_results(results)
+    report = {"machine": platform.machine(), "python": platform.python_version(),
+              "cpus": os.cpu_count(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    # Scripted commands must not pay for the interactive UI, nor for Argon2
+    # when they never hash
+    status = 0
+    for result in results:
+        if result.get("forbidden_modules"):
+            print("STARTUP " + case_key(result) + " imports " +
+                  ", ".join(result["forbidden_modules"]))
+            status = 1
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for result, old in regressions:
+            print("REGRESSION " + case_key(result) + ": p50 " +
+                  "{:.3f} ms -> {:.3f} ms".format(old["p50"] * 1000, result["p50"] * 1000))
+        if regressions:
+            return 1
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from cryptography.exceptions import InvalidTag
+
+from keyring_database import KeyringDB, default_db_path
+import batch
+import ciphers
+import fileio
+import keycache
+
+# Requests and responses are single JSON objects, one per line:
+#
+#   {"op": "ping"}
+#   {"op": "unlock", "key_id": 1, "passphrase": "..."}
+#   {"op": "lock", "key_id": 1}                 key_id omitted locks all keys
+#   {"op": "encrypt", "key_id": 1, "input": "/abs/path", "output": "/abs/path",
+#    "compression": "zlib", "envelope": true, "fsync": "file"}
+#                                                compression, envelope, fsync optional
+#   {"op": "decrypt", ...}                       same fields as encrypt
+#   {"op": "stop"}
+#
+# Every response has "ok" and either the result fields or "error"
+DEFAULT_TTL = 3600
+START_TIMEOUT = 5.0
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+def default_socket_path() -> Path:
+    return default_db_path().parent / "agent.sock"
+
+
+class AgentError(Exception):
+    pass
+
+
+class Agent:
+    # Holds a warm keyring connection and the unlocked keys for the lifetime
+    # of the process. Blocking work runs on the default executor so one slow
+    # file does not hold up other clients
+    def __init__(self, db_path: Path, ttl: float = DEFAULT_TTL):
+        self.keyring_db = KeyringDB(db_path)
+        self.cache = keycache.KeyCache(ttl=ttl)
+        self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Over MAX_REQUEST_SIZE. What is left of the line can't
+                    # be told apart from the next request, so the connection ends
+                    writer.write(json.dumps({"ok": False, "error": "bad request: request too "
+                                             "large"}).encode() + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    response = await self.dispatch(json.loads(line))
+                except (ValueError, KeyError, TypeError) as err:
+                    response = {"ok": False, "error": "bad request: " + str(err)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        op = request["op"]
+
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid(), "keys": len(self.cache)}
+
+        if op == "unlock":
+            argon2_hash = await loop.run_in_executor(
+                None, self.keyring_db.unlock_hash, request["key_id"], request["passphrase"])
+            if argon2_hash is None:
+                return {"ok": False, "error": "unknown key ID or invalid passphrase"}
+            self.cache.put(request["key_id"], ciphers.derive_key(argon2_hash.digest))
+            return {"ok": True}
+
+        if op == "lock":
+            if request.get("key_id") is None:
+                self.cache.clear()
+            else:
+                self.cache.evict(request["key_id"])
+            return {"ok": True}
+
+        if op in ("encrypt", "decrypt"):
+            key = self.cache.get(request["key_id"])
+            if key is None:
+                return {"ok": False, "error": "locked"}
+            try:
+                size = await loop.run_in_executor(
+                    None, run_cipher, op == "decrypt", key,
+                    Path(request["input"]), Path(request["output"]),
+                    request.get("pattern", "**/*"), request.get("compression"),
+                    request.get("envelope", False), request.get("fsync"))
+            except OSError as err:
+                return {"ok": False, "error": str(err)}
+            except (InvalidTag, ValueError):
+                return {"ok": False, "error": "unable to decrypt with provided key"}
+            return {"ok": True, "bytes": size}
+
+        if op == "stop":
+            self.server.close()
+            return {"ok": True}
+
+        return {"ok": False, "error": "unknown op " + str(op)}
+
+    async def serve(self, socket_path: Path):
+        socket_path.unlink(missing_ok=True)
+        # Only the owning user may connect
+        old_umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(
+                self.handle, path=str(socket_path), limit=MAX_REQUEST_SIZE)
+        finally:
+            os.umask(old_umask)
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+            self.cache.clear()
+            self.keyring_db.close()
+
+
+def run_cipher(decrypt: bool, key: bytes, source: Path, output: Path, pattern: str,
+               compression: str = None, envelope: bool = False, fsync: str = None) -> int:
+    # fsync None picks group commit for trees and a sync per file otherwise
+    if source.is_dir():
+        fsync = fsync or "batch"
+        if decrypt:
+            result = batch.decrypt_tree(source, key, output, pattern, fsync=fsync)
+        else:
+            result = batch.encrypt_tree(source, key, output, pattern, compression=compression,
+                                        envelope=envelope, fsync=fsync)
+        if result.failures:
+            path, err = result.failures[0]
+            raise OSError(str(len(result.failures)) + " files failed, first: " +
+                          path.as_posix() + ": " + str(type(err)))
+        return result.bytes
+
+    fsync = fsync or fileio.DEFAULT_FSYNC
+    if decrypt:
+        return ciphers.decrypt_file(source, key, output, fsync=fsync)
+    return ciphers.encrypt_file(source, key, output, compression=compression,
+                                envelope=envelope, fsync=fsync)
+
+
+def request(socket_path: Path, message: dict) -> dict:
+    # Plain blocking socket, so clients don't pay for an event loop
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise AgentError("agent closed the connection")
+
+    return json.loads(line)
+
+
+def is_running(socket_path: Path) -> bool:
+    try:
+        return request(socket_path, {"op": "ping"})["ok"]
+    except (OSError, AgentError, ValueError):
+        return False
+
+
+def start(db_path: Path, socket_path: Path, ttl: float = DEFAULT_TTL) -> int:
+    # Spawns `cli.py agent serve` in its own session and waits for it to answer
+    if is_running(socket_path):
+        return 0
+
+    cli_path = Path(__file__).resolve().parent / "cli.py"
+    subprocess.Popen([sys.executable, str(cli_path), "--db", str(db_path),
+                      "--socket", str(socket_path), "agent", "serve", "--ttl", str(ttl)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if is_running(socket_path):
+            return 0
+        time.sleep(0.05)
+
+    return -1
+
+
+def serve(db_path: Path, socket_path: Path, ttl: float = DEFAULT_TTL):
+    asyncio.run(Agent(db_path, ttl).serve(socket_path))
@@ -0,0 +1,266 @@
+import asyncio
+import functools
+import struct
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from keyring_database import KeyringDB, HashEntry, KeyFilter, PAGE_SIZE
+import ciphers
+import compressors
+import container
+import engine
+
+# Async front end for services running on an event loop. File work runs on
+# a thread pool behind a semaphore, so at most `concurrency` files are in
+# flight and the rest wait on the loop instead of piling up threads.
+# Asyncio streams are encrypted and decrypted chunk by chunk, with reads and
+# writes on the loop and the AEAD pass on the pool. A stream only holds a
+# slot while one of its chunks is being sealed or opened, so slow peers
+# waiting on the network don't keep other work off the pool:
+#
+#   limiter = aio.Limiter(concurrency=8)
+#   await aio.encrypt_file(path, key, output, limiter=limiter)
+#
+#   async with aio.AsyncKeyringDB(db_path) as keyring_db:
+#       argon2_hash = await keyring_db.unlock_hash(1, passphrase)
+DEFAULT_CONCURRENCY = engine.DEFAULT_WORKERS
+
+
+class Limiter:
+    # Caps concurrent operations and owns the threads they run on. The
+    # semaphore and the pool are the same size, so an operation holding a
+    # slot always has a thread to run on
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency,
+                                           thread_name_prefix="lockbox")
+
+    async def run(self, fn, *args, **kwargs):
+        async with self.semaphore:
+            return await self.offload(fn, *args, **kwargs)
+
+    async def offload(self, fn, *args, **kwargs):
+        # Straight to the pool, for callers already holding a slot
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# One shared limiter per event loop, a semaphore can't move between loops
+default_limiters = weakref.WeakKeyDictionary()
+
+
+def get_limiter(limiter: Limiter = None) -> Limiter:
+    if limiter is not None:
+        return limiter
+    loop = asyncio.get_running_loop()
+    if loop not in default_limiters:
+        default_limiters[loop] = Limiter()
+
+    return default_limiters[loop]
+
+
+# Files are processed side by side, so each one is sealed on a single
+# thread by default, as batch trees do
+async def encrypt_file(file_path: Path, key: bytes, output: Path,
+                       chunk_size: int = container.DEFAULT_CHUNK_SIZE, workers: int = 1,
+                       compression: str = None, limiter: Limiter = None) -> int:
+    return await get_limiter(limiter).run(ciphers.encrypt_file, file_path, key, output,
+                                          chunk_size, workers, compression)
+
+
+async def decrypt_file(file_path: Path, key: bytes, output: Path, workers: int = 1,
+                       limiter: Limiter = None) -> int:
+    return await get_limiter(limiter).run(ciphers.decrypt_file, file_path, key, output, workers)
+
+
+async def decrypt_range_file(file_path: Path, key: bytes, output: Path, offset: int,
+                             length: int, limiter: Limiter = None) -> int:
+    return await get_limiter(limiter).run(ciphers.decrypt_range_file, file_path, key,
+                                          output, offset, length)
+
+
+async def read_exactly(reader: asyncio.StreamReader, size: int) -> bytes:
+    # Like read_full, short only at EOF
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as err:
+        return err.partial
+
+
+async def encrypt_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, key: bytes,
+                         chunk_size: int = container.DEFAULT_CHUNK_SIZE,
+                         compression: str = None, limiter: Limiter = None) -> int:
+    # Writes the same container encrypt_file would, without touching disk
+    limiter = get_limiter(limiter)
+    algorithm = compressors.algorithm_id(compression)
+    flags = algorithm | (container.FLAG_INDEX if algorithm else 0)
+    header_bytes = container.Header(container.VERSION, flags, chunk_size).pack()
+    aesgcm = AESGCM(key)
+
+    def seal(index, final, chunk):
+        data = compressors.compress(algorithm, chunk) if algorithm else chunk
+        return container.seal_chunk(aesgcm, header_bytes, index, final, data)
+
+    total = 0
+    lengths = list()
+    writer.write(header_bytes)
+    current = await read_exactly(reader, chunk_size)
+    index = 0
+    while True:
+        following = b""
+        if len(current) == chunk_size:
+            following = await read_exactly(reader, chunk_size)
+        final = len(following) == 0
+        nonce, ciphertext = await limiter.run(seal, index, final, current)
+        if algorithm:
+            writer.write(struct.pack(container.LENGTH_FORMAT, len(ciphertext)))
+            lengths.append(len(ciphertext))
+        writer.write(nonce)
+        writer.write(ciphertext)
+        await writer.drain()
+        total += len(current)
+        if final:
+            break
+        current = following
+        index += 1
+    if algorithm:
+        writer.write(container.END_OF_RECORDS + container.pack_index(lengths))
+        await writer.drain()
+
+    return total
+
+
+async def read_record(reader: asyncio.StreamReader, header: container.Header,
+                      lengths: list) -> bytes:
+    # Next record of a container stream, b"" at the end. lengths collects
+    # the record lengths the index of a compressed container is checked against
+    if not header.compression:
+        return await read_exactly(reader, header.record_size)
+    prefix = await read_exactly(reader, container.LENGTH_SIZE)
+    if len(prefix) == 0:
+        raise ValueError("Truncated container")
+    if prefix == container.END_OF_RECORDS:
+        expected = container.pack_index(lengths)
+        if await read_exactly(reader, len(expected)) != expected or await reader.read(1):
+            raise ValueError("Corrupt record index")
+        return b""
+    length = container.record_length(prefix, header.record_size)
+    record = await read_exactly(reader, length)
+    if len(record) < length:
+        raise ValueError("Truncated record")
+    lengths.append(length - container.NONCE_SIZE)
+
+    return record
+
+
+async def decrypt_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         key: bytes, limiter: Limiter = None) -> int:
+    # Plaintext is written as each chunk authenticates, so a stream that
+    # fails part way has already written the chunks before the bad one
+    limiter = get_limiter(limiter)
+    prefix = await read_exactly(reader, container.HEADER_SIZE)
+    if not container.is_container(prefix):
+        raise ValueError("Not a lockbox container")
+    header = container.parse_header(prefix)
+    header_bytes = header.pack()
+    if header.envelope:
+        envelope = await read_exactly(reader, container.ENVELOPE_SIZE)
+        key = container.unwrap_key(key, envelope, header_bytes)[1]
+    aesgcm = AESGCM(key)
+
+    def unseal(index, final, record):
+        chunk = container.open_chunk(aesgcm, header_bytes, index, final, record)
+        if header.compression:
+            return compressors.decompress(chunk, header.chunk_size)
+        return chunk
+
+    total = 0
+    lengths = list()
+    current = await read_record(reader, header, lengths)
+    if len(current) == 0:
+        raise ValueError("Container has no records")
+    index = 0
+    while True:
+        following = await read_record(reader, header, lengths)
+        final = len(following) == 0
+        chunk = await limiter.run(unseal, index, final, current)
+        writer.write(chunk)
+        await writer.drain()
+        total += len(chunk)
+        if final:
+            break
+        current = following
+        index += 1
+
+    return total
+
+
+class AsyncKeyringDB:
+    # KeyringDB with every call run on one dedicated thread. SQLite
+    # serializes writers anyway, and keeping Argon2 unlocks on that thread
+    # too bounds their memory use to one at a time
+    def __init__(self, db_path: Path):
+        self.keyring_db = KeyringDB(db_path)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lockbox-keyring")
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    async def close(self):
+        await self.call(self.keyring_db.close)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def initial_setup(self):
+        return await self.call(self.keyring_db.initial_setup)
+
+    async def migrate(self) -> int:
+        return await self.call(self.keyring_db.migrate)
+
+    async def get_valid_ids(self) -> list:
+        return await self.call(self.keyring_db.get_valid_ids)
+
+    async def key_exists(self, id: int) -> bool:
+        return await self.call(self.keyring_db.key_exists, id)
+
+    async def has_keys(self) -> bool:
+        return await self.call(self.keyring_db.has_keys)
+
+    async def list_keys(self, after_id: int = 0, limit: int = PAGE_SIZE,
+                        key_filter: KeyFilter = None) -> list:
+        return await self.call(self.keyring_db.list_keys, after_id, limit, key_filter)
+
+    async def store_hash(self, hash_entry: HashEntry) -> int:
+        return await self.call(self.keyring_db.store_hash, hash_entry)
+
+    async def fetch_hash(self, id: int) -> str:
+        return await self.call(self.keyring_db.fetch_hash, id)
+
+    async def unlock_hash(self, hash_id: int, passphrase: str):
+        return await self.call(self.keyring_db.unlock_hash, hash_id, passphrase)
+
+    async def rehash(self, hash_id: int, passphrase: str) -> int:
+        return await self.call(self.keyring_db.rehash, hash_id, passphrase)
+
+    async def delete_hash(self, id: int) -> int:
+        return await self.call(self.keyring_db.delete_hash, id)
+
+    async def edit_comments(self, update: list) -> int:
+        return await self.call(self.keyring_db.edit_comments, update)
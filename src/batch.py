@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import ciphers
+import engine
+import fileio
+import metrics
+from console_config import console
+
+# Files at or under SMALL_FILE_SIZE are grouped into one work item until the
+# group reaches GROUP_BYTES or GROUP_FILES, so queue and thread hand-off cost
+# is paid per group instead of per file. Under the "batch" fsync policy a
+# group is also the unit of group commit
+SMALL_FILE_SIZE = 64 * 1024
+GROUP_BYTES = 4 * 1024 * 1024
+GROUP_FILES = 256
+
+
+@dataclass
+class BatchResult:
+    files: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    failures: list = field(default_factory=list)
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+def collect_files(source: Path, pattern: str = "**/*"):
+    for path in sorted(source.glob(pattern)):
+        if path.is_file():
+            yield path
+
+
+def group_files(paths, failed):
+    # Large files go out on their own, small ones are packed together.
+    # Files that vanish after the walk go to failed(path, err)
+    group = list()
+    group_bytes = 0
+    for path in paths:
+        try:
+            size = path.stat().st_size
+        except OSError as err:
+            failed(path, err)
+            continue
+        if size > SMALL_FILE_SIZE:
+            yield [path]
+            continue
+
+        group.append(path)
+        group_bytes += size
+        if group_bytes >= GROUP_BYTES or len(group) >= GROUP_FILES:
+            yield group
+            group = list()
+            group_bytes = 0
+
+    if group:
+        yield group
+
+
+def run_batch(source: Path, output_dir: Path, job, pattern: str = "**/*",
+              workers: int = engine.DEFAULT_WORKERS, fsync: str = "batch") -> BatchResult:
+    # job(src, dst, group) processes one file and returns the number of bytes
+    # handled. With the "batch" fsync policy group is a fileio.SyncGroup the
+    # job's output joins, committed once the whole file group is done, so
+    # many small files share their syncs. Otherwise group is None.
+    # The queue is bounded, so directory walking blocks once workers fall behind
+    result = BatchResult()
+    lock = threading.Lock()
+    work = queue.Queue(maxsize=workers * 2)
+
+    def failed(src: Path, err: Exception):
+        metrics.count("batch.failures")
+        with lock:
+            result.failures.append((src, err))
+
+    def worker():
+        while True:
+            group = work.get()
+            if group is None:
+                return
+            sync = fileio.SyncGroup() if fsync == "batch" else None
+            done = list()
+            for src in group:
+                dst = output_dir / src.relative_to(source)
+                try:
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    size = job(src, dst, sync)
+                except Exception as err:
+                    # Anything a file raises fails that file, a dead worker
+                    # would leave the walk blocked on the queue
+                    failed(src, err)
+                    continue
+                done.append((src, size))
+            if sync is not None:
+                try:
+                    sync.commit()
+                except Exception as err:
+                    # None of the group's outputs are known to be durable
+                    with lock:
+                        result.failures.extend((src, err) for src, _ in done)
+                    continue
+            with lock:
+                result.files += len(done)
+                result.bytes += sum(size for _, size in done)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(max(workers, 1))]
+    for thread in threads:
+        thread.start()
+    try:
+        for group in group_files(collect_files(source, pattern), failed):
+            work.put(group)
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+    result.elapsed = time.perf_counter() - start
+
+    return result
+
+
+def encrypt_tree(source: Path, key: bytes, output_dir: Path, pattern: str = "**/*",
+                 workers: int = engine.DEFAULT_WORKERS, compression: str = None,
+                 envelope: bool = False, fsync: str = "batch") -> BatchResult:
+    # Parallelism comes from running files side by side, so each file is
+    # sealed on a single thread to avoid oversubscribing the cores
+    def job(src: Path, dst: Path, group: fileio.SyncGroup) -> int:
+        return ciphers.encrypt_file(src, key, dst, workers=1, compression=compression,
+                                    envelope=envelope, fsync=fsync, group=group)
+
+    return run_batch(source, output_dir, job, pattern, workers, fsync)
+
+
+def decrypt_tree(source: Path, key: bytes, output_dir: Path, pattern: str = "**/*",
+                 workers: int = engine.DEFAULT_WORKERS, fsync: str = "batch") -> BatchResult:
+    def job(src: Path, dst: Path, group: fileio.SyncGroup) -> int:
+        return ciphers.decrypt_file(src, key, dst, workers=1, fsync=fsync, group=group)
+
+    return run_batch(source, output_dir, job, pattern, workers, fsync)
+
+
+def print_summary(result: BatchResult):
+    console.print("(+) Processed " + str(result.files) + " files, " +
+                  str(result.bytes) + " bytes in " +
+                  "{:.2f}".format(result.elapsed) + "s (" +
+                  "{:.1f}".format(result.files_per_sec) + " files/s, " +
+                  "{:.1f}".format(result.bytes_per_sec / (1024 * 1024)) + " MiB/s)",
+                  style="header")
+    for path, err in result.failures:
+        console.print("(-) Failed " + path.as_posix() + ": " + str(type(err)),
+                      style="error")
+    if result.failures:
+        console.print("(-) " + str(len(result.failures)) + " files failed",
+                      style="error")
+
+
+def encryption(source: str, digest: str, output_dir: Path, pattern: str = "**/*",
+               workers: int = engine.DEFAULT_WORKERS) -> int:
+    result = encrypt_tree(Path(source), ciphers.derive_key(digest),
+                          output_dir, pattern, workers)
+    print_summary(result)
+
+    return -1 if result.failures else 0
+
+
+def decryption(source: str, digest: str, output_dir: Path, pattern: str = "**/*",
+               workers: int = engine.DEFAULT_WORKERS) -> int:
+    result = decrypt_tree(Path(source), ciphers.derive_key(digest),
+                          output_dir, pattern, workers)
+    print_summary(result)
+
+    return -1 if result.failures else 0
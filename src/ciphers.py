@@ -1,67 +1,180 @@
+import os
+import sys
+from contextlib import nullcontext
 from pathlib import Path
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidTag
-import os
 import base64
 from console_config import console
+import compressors
+import container
+import engine
+import fileio
+import incremental
+import metrics
+import progress as progress_report
 
 
-def encryption(file_path: str, digest: str, output: Path) -> int:
+def derive_key(digest: str) -> bytes:
+    # Argon2 digest is base64 encoded
+    return base64.b64decode(digest + "==")
 
-    # Open file
-    try:
-        file_path = Path(file_path)
-        f = open(file_path, "rb")
-    except Exception as err:
-        console.print("(-) Unable to open file " +
-                      file_path.as_posix() + ": " + str(type(err)), style="error")
-        return -1
-    finally:
-        file_bytes = bytearray(f.read())
-        f.close()
 
-    # Argon2 digest is base64 encoded
-    digest = base64.b64decode(digest + "==")
-    aesgcm = AESGCM(digest)
-    nonce = os.urandom(12)
-    ciphertext = aesgcm.encrypt(nonce, file_bytes, None)
+def encode_key(key: bytes) -> str:
+    # Inverse of derive_key, gives back the unpadded digest
+    return base64.b64encode(key).decode().rstrip("=")
+
+
+def open_input(path):
+    if fileio.is_stdio(path):
+        return nullcontext(sys.stdin.buffer)
+    return open(path, "rb")
+
+
+def open_output(path, fsync: str = fileio.DEFAULT_FSYNC, group: fileio.SyncGroup = None):
+    # Files are written next to the target and renamed over it when done,
+    # see fileio.atomic_output for the fsync policies
+    if fileio.is_stdio(path):
+        return nullcontext(sys.stdout.buffer)
+    return fileio.atomic_output(path, fsync, group)
+
+
+@metrics.timed("cipher.encrypt_file", returns_bytes=True)
+def encrypt_file(file_path: Path, key: bytes, output: Path,
+                 chunk_size: int = container.DEFAULT_CHUNK_SIZE,
+                 workers: int = engine.DEFAULT_WORKERS, compression: str = None,
+                 progress=None, envelope: bool = False, fsync: str = fileio.DEFAULT_FSYNC,
+                 group: fileio.SyncGroup = None) -> int:
+    # compression names one of compressors.available(), None stores chunks as
+    # is. progress is a callable fed with input bytes, see progress.Progress.
+    # envelope seals the data with a random key wrapped by key, so moving
+    # the file to another key only rewrites the envelope
+    algorithm = compressors.algorithm_id(compression)
+    with open_input(file_path) as src, open_output(output, fsync, group) as dst:
+        total = container.encrypt_stream(src, dst, key, chunk_size, workers, algorithm,
+                                         progress, envelope)
+        dst.flush()
+
+    return total
+
+
+@metrics.timed("cipher.encrypt_incremental")
+def encrypt_file_incremental(file_path: Path, key: bytes, output: Path,
+                             chunk_size: int = container.DEFAULT_CHUNK_SIZE,
+                             workers: int = engine.DEFAULT_WORKERS, progress=None,
+                             fsync: str = fileio.DEFAULT_FSYNC) -> tuple:
+    # Re-encrypts over an earlier output, sealing only the chunks that
+    # changed since. Returns (plaintext bytes, chunks rewritten, chunks).
+    # The output is updated in place, so it is synced but never renamed
+    output = Path(output)
+    manifest = incremental.manifest_path(output)
+    previous = incremental.load_manifest(manifest, chunk_size) if output.exists() else []
+    with open_input(file_path) as src, open(output, "r+b" if previous else "w+b") as dst:
+        total, rewritten, chunks = incremental.update_stream(
+            src, dst, key, previous, chunk_size, workers, progress)
+        dst.flush()
+        if fsync != "none":
+            os.fsync(dst.fileno())
+    incremental.save_manifest(manifest, chunk_size, chunks)
+    metrics.count("incremental.chunks_rewritten", rewritten)
+    metrics.count("incremental.chunks_reused", len(chunks) - rewritten)
 
-    # Attach nonce to ciphertext for decrypting
-    ciphertext_nonce = nonce + ciphertext
+    return total, rewritten, len(chunks)
 
-    with open(output, "wb") as of:
-        of.write(ciphertext_nonce)
 
-    console.print("(+) Encrypted data written to " +
-                  output.as_posix(), style="header")
+@metrics.timed("cipher.decrypt_file", returns_bytes=True)
+def decrypt_file(file_path: Path, key: bytes, output: Path,
+                 workers: int = engine.DEFAULT_WORKERS, progress=None,
+                 fsync: str = fileio.DEFAULT_FSYNC, group: fileio.SyncGroup = None) -> int:
+    # A failed tag leaves output untouched, the partial plaintext only ever
+    # lands in the temp file
+    with open_input(file_path) as src:
+        prefix = container.read_full(src, container.HEADER_SIZE)
+        if progress is not None:
+            progress(len(prefix))
+        if container.is_container(prefix):
+            header = container.parse_header(prefix)
+            with open_output(output, fsync, group) as dst:
+                total = container.decrypt_stream(src, dst, key, header, workers, progress)
+                dst.flush()
+            return total
 
+        # Single-shot nonce || ciphertext files from before the container format.
+        # The whole file is one AEAD message, mapped files are sliced in place
+        with fileio.map_input(src) as buf:
+            if buf is None:
+                buf = memoryview(prefix + src.read())
+            aesgcm = AESGCM(key)
+            cleartext = aesgcm.decrypt(buf[:12], buf[12:], None)
+            if progress is not None:
+                progress(len(buf) - len(prefix))
+    with open_output(output, fsync, group) as of:
+        of.write(cleartext)
+        of.flush()
+
+    return len(cleartext)
+
+
+def open_encrypted(file_path: Path, key: bytes) -> container.EncryptedReader:
+    # File-like object over the plaintext, decrypting only what is read
+    src = open(file_path, "rb")
+    try:
+        return container.EncryptedReader(src, key)
+    except BaseException:
+        src.close()
+        raise
+
+
+@metrics.timed("cipher.decrypt_range", returns_bytes=True)
+def decrypt_range_file(file_path: Path, key: bytes, output: Path,
+                       offset: int, length: int, fsync: str = fileio.DEFAULT_FSYNC) -> int:
+    with open_encrypted(file_path, key) as reader, open_output(output, fsync) as dst:
+        total = container.decrypt_range(reader, dst, offset, length)
+        dst.flush()
+
+    return total
 
-def decryption(file_path: str, digest: str, output: Path):
 
-    # Open file
+def encryption(file_path: str, digest: str, output: Path,
+               workers: int = engine.DEFAULT_WORKERS, compression: str = None,
+               envelope: bool = False, fsync: str = fileio.DEFAULT_FSYNC) -> int:
+    file_path = Path(file_path)
     try:
-        file_path = Path(file_path)
-        f = open(file_path, "rb")
-    except Exception as err:
-        console.print("(-) Unable to open file " +
+        with progress_report.bar(progress_report.input_size(file_path), "Encrypting") as report:
+            encrypt_file(file_path, derive_key(digest), output, workers=workers,
+                         compression=compression, progress=report, envelope=envelope,
+                         fsync=fsync)
+    except OSError as err:
+        console.print("(-) Unable to encrypt file " +
                       file_path.as_posix() + ": " + str(type(err)), style="error")
         return -1
-    finally:
-        file_bytes = bytearray(f.read())
-        f.close()
-
-    digest = base64.b64decode(digest + "==")
-    nonce = file_bytes[:12]
-    ciphertext = file_bytes[12:]
-    aesgcm = AESGCM(digest)
+
+    # Keep stdout clean when it carries the data
+    if not fileio.is_stdio(output):
+        console.print("(+) Encrypted data written to " +
+                      output.as_posix(), style="header")
+
+    return 0
+
+
+def decryption(file_path: str, digest: str, output: Path,
+               workers: int = engine.DEFAULT_WORKERS, fsync: str = fileio.DEFAULT_FSYNC) -> int:
+    file_path = Path(file_path)
     try:
-        cleartext = aesgcm.decrypt(nonce, ciphertext, None)
-    except InvalidTag:
-        print("Unable to decrypt data with provided key")
-        return
+        with progress_report.bar(progress_report.input_size(file_path), "Decrypting") as report:
+            decrypt_file(file_path, derive_key(digest), output, workers, report, fsync)
+    except OSError as err:
+        console.print("(-) Unable to decrypt file " +
+                      file_path.as_posix() + ": " + str(type(err)), style="error")
+        return -1
+    except (InvalidTag, ValueError):
+        console.print("(-) Unable to decrypt data with provided key",
+                      style="error")
+        return -1
 
-    with open(output, "wb") as of:
-        of.write(cleartext)
+    # Keep stdout clean when it carries the data
+    if not fileio.is_stdio(output):
+        console.print("(+) Decrypted data written to " +
+                      output.as_posix(), style="header")
 
-    console.print("(+) Encrypted data written to " +
-                  output.as_posix(), style="header")
+    return 0
@@ -0,0 +1,641 @@
+import argparse
+import json
+import os
+import sys
+from contextlib import nullcontext
+from datetime import datetime
+from getpass import getpass
+from pathlib import Path
+
+from keyring_database import (KeyringDB, HashEntry, KeyFilter, CREATED_FORMAT,
+                              default_db_path, default_params_path)
+import fileio
+import hashing
+import metrics
+import progress
+
+# cryptography, the thread pool, the compressors and the agent's asyncio are
+# imported by the commands that use them, so `keys list` and `--help` don't
+# load them
+
+# Exit codes for scripted use
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_AUTH = 3
+
+
+class CommandError(Exception):
+    def __init__(self, message: str, code: int = EXIT_FAILURE):
+        super().__init__(message)
+        self.code = code
+
+
+def open_keyring(db_path: Path) -> KeyringDB:
+    keyring_db = KeyringDB(db_path)
+    if not db_path.exists():
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        keyring_db.initial_setup()
+    else:
+        keyring_db.migrate()
+
+    return keyring_db
+
+
+def read_passphrase(args, name: str = "passphrase") -> str:
+    # fd and environment sources keep the passphrase out of argv and ps output.
+    # name selects the --NAME-fd/--NAME-env pair, see add_passphrase_args
+    fd = getattr(args, name + "_fd")
+    env = getattr(args, name + "_env")
+    option = "--" + name.replace("_", "-")
+    if fd is not None:
+        with os.fdopen(fd, "r", closefd=False) as f:
+            passphrase = f.readline().rstrip("\r\n")
+    elif env is not None:
+        passphrase = os.environ.get(env)
+        if passphrase is None:
+            raise CommandError("environment variable " + env + " is not set", EXIT_USAGE)
+    elif sys.stdin.isatty():
+        passphrase = getpass(name.replace("_", " ").capitalize() + ": ")
+    else:
+        raise CommandError("no " + name.replace("_", " ") + " given, use " + option +
+                           "-fd or " + option + "-env", EXIT_USAGE)
+
+    return passphrase
+
+
+def unlock_id(keyring_db: KeyringDB, key_id: int, passphrase: str) -> str:
+    argon2_hash = keyring_db.unlock_hash(key_id, passphrase)
+    if argon2_hash is None:
+        raise CommandError("unknown key ID or invalid passphrase for key ID " +
+                           str(key_id), EXIT_AUTH)
+    if hashing.needs_rehash(argon2_hash):
+        metrics.count("kdf.rehash_notice")
+        print("lockbox: key ID " + str(key_id) + " uses outdated Argon2 parameters, "
+              "see keys rehash", file=sys.stderr)
+
+    return argon2_hash.digest
+
+
+def unlock_key(keyring_db: KeyringDB, args) -> str:
+    if fileio.is_stdio(args.input) and args.passphrase_fd == 0:
+        raise CommandError("stdin carries the input, pass the passphrase on another fd",
+                           EXIT_USAGE)
+
+    return unlock_id(keyring_db, args.key_id, read_passphrase(args))
+
+
+def socket_path(args) -> Path:
+    import agent
+    return args.socket if args.socket is not None else agent.default_socket_path()
+
+
+def agent_request(args, message: dict) -> dict:
+    import agent
+    try:
+        return agent.request(socket_path(args), message)
+    except (OSError, agent.AgentError) as err:
+        raise CommandError("unable to reach agent at " + str(socket_path(args)) + ": " +
+                           str(err))
+
+
+def run_agent_cipher(args, decrypt: bool) -> int:
+    # The agent runs in another directory, so paths are sent absolute
+    if fileio.is_stdio(args.input) or fileio.is_stdio(args.output):
+        raise CommandError("stdin/stdout can't be handed to the agent", EXIT_USAGE)
+    message = {"op": "decrypt" if decrypt else "encrypt", "key_id": args.key_id,
+               "input": str(Path(args.input).resolve()),
+               "output": str(Path(args.output).resolve()),
+               "pattern": args.pattern, "compression": getattr(args, "compress", None),
+               "envelope": getattr(args, "envelope", False), "fsync": args.fsync}
+
+    response = agent_request(args, message)
+    if not response["ok"] and response["error"] == "locked":
+        cmd_agent_unlock(args)
+        response = agent_request(args, message)
+    if not response["ok"]:
+        raise CommandError(response["error"])
+
+    return EXIT_OK
+
+
+def run_cipher(args, decrypt: bool) -> int:
+    from cryptography.exceptions import InvalidTag
+    import batch
+    import ciphers
+    import compressors
+    import engine
+    incremental = getattr(args, "incremental", False)
+    compression = getattr(args, "compress", None)
+    envelope = getattr(args, "envelope", False)
+    if compression is not None and compression not in compressors.available():
+        raise CommandError("unsupported compression " + compression + ", available: " +
+                           ", ".join(compressors.available()), EXIT_USAGE)
+    if args.workers is None:
+        args.workers = engine.DEFAULT_WORKERS
+    if incremental and (args.agent or fileio.is_stdio(args.output) or
+                        Path(args.input).is_dir()):
+        raise CommandError("--incremental needs a single input file and an output path",
+                           EXIT_USAGE)
+    if incremental and (compression or envelope):
+        raise CommandError("--incremental can't be combined with --compress or --envelope",
+                           EXIT_USAGE)
+    source = Path(args.input)
+    output = Path(args.output)
+    # A rerun would pick up the previous outputs as inputs
+    if source.is_dir() and output.resolve().is_relative_to(source.resolve()):
+        raise CommandError("output directory must be outside of the input tree", EXIT_USAGE)
+    if args.agent:
+        return run_agent_cipher(args, decrypt)
+
+    with open_keyring(args.db) as keyring_db:
+        digest = unlock_key(keyring_db, args)
+
+    if source.is_dir():
+        fsync = args.fsync or "batch"
+        if decrypt:
+            result = batch.decrypt_tree(source, ciphers.derive_key(digest), output,
+                                        args.pattern, args.workers, fsync)
+        else:
+            result = batch.encrypt_tree(source, ciphers.derive_key(digest), output,
+                                        args.pattern, args.workers, compression, envelope,
+                                        fsync)
+        if args.pretty:
+            batch.print_summary(result)
+        else:
+            for path, err in result.failures:
+                print("lockbox: failed " + path.as_posix() + ": " + str(type(err)),
+                      file=sys.stderr)
+        return EXIT_FAILURE if result.failures else EXIT_OK
+
+    fsync = args.fsync or fileio.DEFAULT_FSYNC
+    if args.pretty and decrypt:
+        return EXIT_FAILURE if ciphers.decryption(source, digest, output, args.workers,
+                                                  fsync) == -1 else EXIT_OK
+    if args.pretty and not incremental:
+        return EXIT_FAILURE if ciphers.encryption(source, digest, output, args.workers,
+                                                  compression, envelope,
+                                                  fsync) == -1 else EXIT_OK
+
+    lines = nullcontext()
+    if args.progress:
+        lines = progress.lines(progress.input_size(source), args.command)
+    try:
+        with lines as report:
+            if decrypt:
+                ciphers.decrypt_file(source, ciphers.derive_key(digest), output,
+                                     args.workers, report, fsync)
+            elif incremental:
+                ciphers.encrypt_file_incremental(source, ciphers.derive_key(digest), output,
+                                                 workers=args.workers, progress=report,
+                                                 fsync=fsync)
+            else:
+                ciphers.encrypt_file(source, ciphers.derive_key(digest), output,
+                                     workers=args.workers, compression=compression,
+                                     progress=report, envelope=envelope, fsync=fsync)
+    except OSError as err:
+        raise CommandError(source.as_posix() + ": " + str(err))
+    except (InvalidTag, ValueError):
+        raise CommandError("unable to decrypt " + source.as_posix() +
+                           " with provided key", EXIT_AUTH)
+
+    return EXIT_OK
+
+
+def cmd_rotate(args) -> int:
+    import batch
+    import ciphers
+    import engine
+    import rotate
+    if args.workers is None:
+        args.workers = engine.DEFAULT_WORKERS
+    if args.old_key_id == args.new_key_id:
+        raise CommandError("old and new key IDs are the same", EXIT_USAGE)
+    with open_keyring(args.db) as keyring_db:
+        old_digest = unlock_id(keyring_db, args.old_key_id, read_passphrase(args))
+        new_digest = unlock_id(keyring_db, args.new_key_id,
+                               read_passphrase(args, "new_passphrase"))
+
+    journal = args.journal
+    if journal is None:
+        journal = args.db.parent / ("rotate-" + str(args.old_key_id) + "-" +
+                                    str(args.new_key_id) + ".journal")
+    result = rotate.rotate_files(args.paths, ciphers.derive_key(old_digest),
+                                 ciphers.derive_key(new_digest), journal, args.workers)
+    if args.pretty:
+        batch.print_summary(result)
+    else:
+        for path, err in result.failures:
+            print("lockbox: failed " + path.as_posix() + ": " + str(type(err)),
+                  file=sys.stderr)
+    if result.failures:
+        print("lockbox: rerun the same command to resume, progress is kept in " +
+              str(journal), file=sys.stderr)
+        return EXIT_FAILURE
+
+    return EXIT_OK
+
+
+def cmd_encrypt(args) -> int:
+    return run_cipher(args, decrypt=False)
+
+
+def cmd_decrypt(args) -> int:
+    return run_cipher(args, decrypt=True)
+
+
+def parse_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a date as YYYY-MM-DD")
+
+
+def cmd_read(args) -> int:
+    from cryptography.exceptions import InvalidTag
+    import ciphers
+    with open_keyring(args.db) as keyring_db:
+        digest = unlock_key(keyring_db, args)
+
+    try:
+        ciphers.decrypt_range_file(Path(args.input), ciphers.derive_key(digest),
+                                   Path(args.output), args.offset, args.length,
+                                   args.fsync or fileio.DEFAULT_FSYNC)
+    except OSError as err:
+        raise CommandError(args.input + ": " + str(err))
+    except (InvalidTag, ValueError, IndexError):
+        raise CommandError("unable to decrypt " + args.input +
+                           " with provided key", EXIT_AUTH)
+
+    return EXIT_OK
+
+
+def cmd_keys_list(args) -> int:
+    key_filter = KeyFilter(args.comment, args.since, args.until,
+                           args.memory_below, args.time_below)
+    with open_keyring(args.db) as keyring_db:
+        if args.pretty:
+            return EXIT_FAILURE if keyring_db.dump_keys(key_filter) == -1 else EXIT_OK
+
+        if args.limit is not None:
+            rows = keyring_db.list_keys(args.after, args.limit, key_filter)
+        else:
+            rows = keyring_db.iter_keys(key_filter, args.after)
+
+        for id, created, comments, hash in rows:
+            if args.json:
+                print(json.dumps({"id": id, "created": created,
+                                  "comments": comments, "hash": hash}))
+            else:
+                print(str(id) + "\t" + created + "\t" + comments + "\t" + hash)
+
+        return EXIT_OK
+
+
+def cmd_keys_export(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        if fileio.is_stdio(args.file):
+            keyring_db.export_entries(sys.stdout)
+        else:
+            with open(args.file, "w") as dst:
+                keyring_db.export_entries(dst)
+
+    return EXIT_OK
+
+
+def cmd_keys_import(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        if fileio.is_stdio(args.file):
+            count = keyring_db.import_entries(sys.stdin, args.on_conflict)
+        else:
+            with open(args.file, "r") as src:
+                count = keyring_db.import_entries(src, args.on_conflict)
+
+    return EXIT_FAILURE if count == -1 else EXIT_OK
+
+
+def cmd_keys_add(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        hash_entry = HashEntry(date=datetime.now().strftime(CREATED_FORMAT),
+                               comments=args.comment,
+                               hash=hashing.hash_passphrase(read_passphrase(args)))
+
+        return EXIT_FAILURE if keyring_db.store_hash(hash_entry) == -1 else EXIT_OK
+
+
+def cmd_keys_delete(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        if not keyring_db.key_exists(args.key_id):
+            raise CommandError("key ID " + str(args.key_id) + " does not exist")
+
+        return EXIT_FAILURE if keyring_db.delete_hash(args.key_id) == -1 else EXIT_OK
+
+
+def cmd_keys_edit(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        if not keyring_db.key_exists(args.key_id):
+            raise CommandError("key ID " + str(args.key_id) + " does not exist")
+
+        return EXIT_FAILURE if keyring_db.edit_comments([args.comment, args.key_id]) == -1 else EXIT_OK
+
+
+def cmd_keys_rehash(args) -> int:
+    with open_keyring(args.db) as keyring_db:
+        if keyring_db.rehash(args.key_id, read_passphrase(args)) == -1:
+            raise CommandError("unknown key ID or invalid passphrase for key ID " +
+                               str(args.key_id), EXIT_AUTH)
+
+    return EXIT_OK
+
+
+def cmd_kdf_show(args) -> int:
+    params = hashing.current_params()
+    print("memory_cost=" + str(params.memory_cost) + " time_cost=" + str(params.time_cost) +
+          " parallelism=" + str(params.parallelism))
+
+    return EXIT_OK
+
+
+def cmd_kdf_calibrate(args) -> int:
+    params = hashing.calibrate(args.target_ms / 1000, args.max_memory * 1024)
+    elapsed = hashing.time_params(params)
+    print("memory_cost=" + str(params.memory_cost) + " time_cost=" + str(params.time_cost) +
+          " parallelism=" + str(params.parallelism) +
+          " ({:.0f} ms)".format(elapsed * 1000))
+    if elapsed * 1000 > args.target_ms:
+        print("lockbox: the smallest parameters tried already take longer than " +
+              "{:.0f} ms".format(args.target_ms), file=sys.stderr)
+    if args.save:
+        args.params.parent.mkdir(parents=True, exist_ok=True)
+        hashing.save_params(args.params, params)
+
+    return EXIT_OK
+
+
+def agent_ttl(args) -> float:
+    import agent
+    return args.ttl if args.ttl is not None else agent.DEFAULT_TTL
+
+
+def cmd_agent_start(args) -> int:
+    import agent
+    open_keyring(args.db).close()
+    if agent.start(args.db, socket_path(args), agent_ttl(args)) == -1:
+        raise CommandError("agent did not start within " + str(agent.START_TIMEOUT) + "s")
+
+    return EXIT_OK
+
+
+def cmd_agent_serve(args) -> int:
+    import agent
+    open_keyring(args.db).close()
+    agent.serve(args.db, socket_path(args), agent_ttl(args))
+
+    return EXIT_OK
+
+
+def cmd_agent_stop(args) -> int:
+    import agent
+    if agent.is_running(socket_path(args)):
+        agent_request(args, {"op": "stop"})
+
+    return EXIT_OK
+
+
+def cmd_agent_status(args) -> int:
+    import agent
+    if not agent.is_running(socket_path(args)):
+        print("not running")
+        return EXIT_FAILURE
+
+    response = agent_request(args, {"op": "ping"})
+    print("running, pid " + str(response["pid"]) + ", " +
+          str(response["keys"]) + " unlocked keys")
+
+    return EXIT_OK
+
+
+def cmd_agent_unlock(args) -> int:
+    response = agent_request(args, {"op": "unlock", "key_id": args.key_id,
+                                    "passphrase": read_passphrase(args)})
+    if not response["ok"]:
+        raise CommandError(response["error"], EXIT_AUTH)
+
+    return EXIT_OK
+
+
+def cmd_agent_lock(args) -> int:
+    agent_request(args, {"op": "lock", "key_id": args.key_id})
+
+    return EXIT_OK
+
+
+def add_passphrase_args(parser: argparse.ArgumentParser, name: str = "passphrase"):
+    option = "--" + name.replace("_", "-")
+    label = name.replace("_", " ")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(option + "-fd", type=int, metavar="FD",
+                       help="read the " + label + " from a file descriptor")
+    group.add_argument(option + "-env", metavar="VAR",
+                       help="read the " + label + " from an environment variable")
+
+
+def add_fsync_arg(parser: argparse.ArgumentParser):
+    parser.add_argument("--fsync", choices=fileio.FSYNC_POLICIES,
+                        help="sync each output (file), groups of outputs together (batch) "
+                             "or leave it to the OS (none); batch for directories and "
+                             "file otherwise by default")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="lockbox", description="Encrypt and decrypt files without the interactive menus")
+    parser.add_argument("--db", type=Path, default=default_db_path(),
+                        help="path to the keyring database")
+    parser.add_argument("--pretty", action="store_true",
+                        help="render output with Rich")
+    parser.add_argument("--params", type=Path, default=default_params_path(),
+                        help="path of the calibrated Argon2 parameters")
+    parser.add_argument("--socket", type=Path,
+                        help="path of the key agent socket, next to the keyring by default")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write per-stage timings and byte counts to FILE, - for stderr")
+    parser.add_argument("--metrics-format", choices=("json", "prometheus"), default="json")
+    parser.add_argument("--profile", choices=metrics.PROFILE_MODES,
+                        help="capture a cProfile or tracemalloc profile of the run")
+    parser.add_argument("--profile-output", metavar="FILE", default="lockbox.profile",
+                        help="where --profile writes its capture")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, func, verb in (("encrypt", cmd_encrypt, "encrypt"),
+                             ("decrypt", cmd_decrypt, "decrypt")):
+        sub = subparsers.add_parser(name, help=verb + " a file or directory tree")
+        sub.add_argument("input", help="file or directory to " + verb + ", - for stdin")
+        sub.add_argument("output", help="output file or directory, - for stdout")
+        sub.add_argument("-k", "--key-id", type=int, required=True,
+                         help="keyring ID of the key to use")
+        sub.add_argument("--pattern", default="**/*",
+                         help="glob of files to include when input is a directory")
+        sub.add_argument("--workers", type=int,
+                         help="number of worker threads, one per CPU core by default")
+        sub.add_argument("--agent", action="store_true",
+                         help="hand the work to the running key agent")
+        sub.add_argument("--progress", action="store_true",
+                         help="report progress as JSON lines on stderr (a bar with --pretty)")
+        add_fsync_arg(sub)
+        if name == "encrypt":
+            sub.add_argument("--incremental", action="store_true",
+                             help="update an earlier output in place, re-encrypting only "
+                                  "the chunks that changed")
+            sub.add_argument("--compress", metavar="ALGORITHM",
+                             help="compress chunks before encrypting them: zlib, lzma, bz2 "
+                                  "or zstd (needs the zstandard package)")
+            sub.add_argument("--envelope", action="store_true",
+                             help="encrypt with a random data key wrapped by the keyring key, "
+                                  "so rotate only rewrites the file header")
+        add_passphrase_args(sub)
+        sub.set_defaults(func=func, hashes=True)
+
+    sub = subparsers.add_parser("rotate", help="move encrypted files to another key in place")
+    sub.add_argument("paths", nargs="+", help="encrypted files or directories")
+    sub.add_argument("--old-key-id", type=int, required=True,
+                     help="keyring ID the files are encrypted with")
+    sub.add_argument("--new-key-id", type=int, required=True,
+                     help="keyring ID to encrypt them with")
+    sub.add_argument("--journal", type=Path,
+                     help="progress journal, next to the keyring by default")
+    sub.add_argument("--workers", type=int,
+                     help="number of files rotated at once, one per CPU core by default")
+    add_passphrase_args(sub)
+    add_passphrase_args(sub, "new_passphrase")
+    sub.set_defaults(func=cmd_rotate, hashes=True)
+
+    sub = subparsers.add_parser("read", help="decrypt a byte range of an encrypted file")
+    sub.add_argument("input", help="encrypted file")
+    sub.add_argument("output", help="output file, - for stdout")
+    sub.add_argument("-k", "--key-id", type=int, required=True,
+                     help="keyring ID of the key to use")
+    sub.add_argument("--offset", type=int, default=0, help="first plaintext byte")
+    sub.add_argument("--length", type=int, required=True, help="number of bytes")
+    add_fsync_arg(sub)
+    add_passphrase_args(sub)
+    sub.set_defaults(func=cmd_read, hashes=True)
+
+    keys = subparsers.add_parser("keys", help="manage the keyring")
+    keys_sub = keys.add_subparsers(dest="keys_command", required=True)
+
+    sub = keys_sub.add_parser("list", help="list stored keys")
+    sub.add_argument("--json", action="store_true", help="one JSON object per line")
+    sub.add_argument("--after", type=int, default=0, metavar="ID",
+                     help="only keys with an ID above this, for paging")
+    sub.add_argument("--limit", type=int, help="maximum number of keys to list")
+    sub.add_argument("--comment", help="only keys whose comment contains this text")
+    sub.add_argument("--since", type=parse_date, help="created on or after YYYY-MM-DD")
+    sub.add_argument("--until", type=parse_date, help="created before YYYY-MM-DD")
+    sub.add_argument("--memory-below", type=int, metavar="KIB",
+                     help="only keys hashed with less Argon2 memory than this")
+    sub.add_argument("--time-below", type=int, metavar="PASSES",
+                     help="only keys hashed with fewer Argon2 passes than this")
+    sub.set_defaults(func=cmd_keys_list)
+
+    sub = keys_sub.add_parser("export", help="write all keys as JSON Lines")
+    sub.add_argument("file", nargs="?", default="-", help="output file, - for stdout")
+    sub.set_defaults(func=cmd_keys_export)
+
+    sub = keys_sub.add_parser("import", help="read keys from JSON Lines")
+    sub.add_argument("file", nargs="?", default="-", help="input file, - for stdin")
+    sub.add_argument("--on-conflict", default="abort",
+                     choices=("abort", "skip", "replace", "renumber"),
+                     help="what to do with rows whose ID already exists")
+    sub.set_defaults(func=cmd_keys_import)
+
+    sub = keys_sub.add_parser("add", help="add a key derived from a passphrase")
+    sub.add_argument("-c", "--comment", default="", help="comment for the entry")
+    add_passphrase_args(sub)
+    sub.set_defaults(func=cmd_keys_add, hashes=True)
+
+    sub = keys_sub.add_parser("delete", help="delete a key")
+    sub.add_argument("key_id", type=int)
+    sub.set_defaults(func=cmd_keys_delete)
+
+    sub = keys_sub.add_parser("edit", help="replace the comment of a key")
+    sub.add_argument("key_id", type=int)
+    sub.add_argument("-c", "--comment", required=True, help="new comment")
+    sub.set_defaults(func=cmd_keys_edit)
+
+    sub = keys_sub.add_parser("rehash",
+                              help="add a copy of a key hashed with the current Argon2 parameters")
+    sub.add_argument("key_id", type=int)
+    add_passphrase_args(sub)
+    sub.set_defaults(func=cmd_keys_rehash, hashes=True)
+
+    kdf = subparsers.add_parser("kdf", help="Argon2 parameters for new keys")
+    kdf_sub = kdf.add_subparsers(dest="kdf_command", required=True)
+
+    sub = kdf_sub.add_parser("show", help="print the parameters in use")
+    sub.set_defaults(func=cmd_kdf_show, hashes=True)
+
+    sub = kdf_sub.add_parser("calibrate", help="pick parameters for a target unlock time")
+    sub.add_argument("--target-ms", type=float, default=hashing.DEFAULT_TARGET_SECONDS * 1000,
+                     help="target time of one hash in milliseconds")
+    sub.add_argument("--max-memory", type=int, default=hashing.MAX_MEMORY_COST // 1024,
+                     metavar="MIB", help="upper bound on memory per hash")
+    sub.add_argument("--save", action="store_true",
+                     help="use the result for new keys from now on")
+    sub.set_defaults(func=cmd_kdf_calibrate)
+
+    agents = subparsers.add_parser("agent", help="run or control the key agent")
+    agents_sub = agents.add_subparsers(dest="agent_command", required=True)
+
+    for name, func, help in (("start", cmd_agent_start, "start the agent in the background"),
+                             ("serve", cmd_agent_serve, "run the agent in the foreground")):
+        sub = agents_sub.add_parser(name, help=help)
+        sub.add_argument("--ttl", type=float,
+                         help="seconds an unlocked key stays in the agent (default 3600)")
+        sub.set_defaults(func=func)
+
+    sub = agents_sub.add_parser("stop", help="stop the agent")
+    sub.set_defaults(func=cmd_agent_stop)
+
+    sub = agents_sub.add_parser("status", help="show whether the agent is running")
+    sub.set_defaults(func=cmd_agent_status)
+
+    sub = agents_sub.add_parser("unlock", help="unlock a key in the agent")
+    sub.add_argument("-k", "--key-id", type=int, required=True)
+    add_passphrase_args(sub)
+    sub.set_defaults(func=cmd_agent_unlock)
+
+    sub = agents_sub.add_parser("lock", help="forget one or all unlocked keys")
+    sub.add_argument("-k", "--key-id", type=int, help="key to lock, all when omitted")
+    sub.set_defaults(func=cmd_agent_lock)
+
+    return parser
+
+
+def write_metrics(args):
+    # stdout may carry file data, so "-" goes to stderr
+    report = metrics.export(args.metrics_format)
+    if args.metrics == "-":
+        sys.stderr.write(report)
+        return
+    with open(args.metrics, "w") as f:
+        f.write(report)
+
+
+def main(argv: list) -> int:
+    args = build_parser().parse_args(argv)
+    if args.metrics is not None:
+        metrics.enable()
+    capture = metrics.profile(args.profile, args.profile_output) if args.profile else nullcontext()
+    if getattr(args, "hashes", False):
+        # Only commands that hash or check key parameters read the file
+        hashing.set_params(hashing.load_params(args.params))
+    try:
+        with capture:
+            return args.func(args)
+    except CommandError as err:
+        print("lockbox: " + str(err), file=sys.stderr)
+        return err.code
+    finally:
+        if args.metrics is not None:
+            write_metrics(args)
@@ -0,0 +1,97 @@
+import bz2
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Algorithms a container can be compressed with. The id is stored in the
+# low bits of the header flags and in front of every compressed chunk, 0
+# marks a chunk that was stored as is
+STORED = 0
+ZLIB = 1
+LZMA = 2
+BZ2 = 3
+ZSTD = 4
+
+
+def zstd_compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def zstd_decompress(data: bytes, max_size: int) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+
+
+def bounded_decompress(decompressor, data: bytes, max_size: int) -> bytes:
+    # Inflates at most one byte past max_size, so a chunk that expands
+    # beyond the chunk size is caught without allocating all of it
+    data = decompressor.decompress(data, max_size + 1)
+    if len(data) <= max_size and not decompressor.eof:
+        raise ValueError("Truncated compressed chunk")
+
+    return data
+
+
+def zlib_decompress(data: bytes, max_size: int) -> bytes:
+    return bounded_decompress(zlib.decompressobj(), data, max_size)
+
+
+def lzma_decompress(data: bytes, max_size: int) -> bytes:
+    return bounded_decompress(lzma.LZMADecompressor(), data, max_size)
+
+
+def bz2_decompress(data: bytes, max_size: int) -> bytes:
+    return bounded_decompress(bz2.BZ2Decompressor(), data, max_size)
+
+
+ALGORITHMS = {
+    ZLIB: ("zlib", zlib.compress, zlib_decompress),
+    LZMA: ("lzma", lzma.compress, lzma_decompress),
+    BZ2: ("bz2", bz2.compress, bz2_decompress),
+}
+if zstandard is not None:
+    ALGORITHMS[ZSTD] = ("zstd", zstd_compress, zstd_decompress)
+
+ALGORITHM_IDS = {name: algorithm for algorithm, (name, _, _) in ALGORITHMS.items()}
+
+
+def algorithm_id(name: str) -> int:
+    if name is None or name == "none":
+        return STORED
+    if name not in ALGORITHM_IDS:
+        raise ValueError("Unsupported compression " + name)
+
+    return ALGORITHM_IDS[name]
+
+
+def available() -> list:
+    return sorted(ALGORITHM_IDS)
+
+
+def compress(algorithm: int, data) -> bytes:
+    # Returns the algorithm id the chunk ended up with followed by the
+    # payload. Chunks that don't get smaller are stored as they are
+    compressed = ALGORITHMS[algorithm][1](data)
+    if len(compressed) >= len(data):
+        return bytes([STORED]) + data
+
+    return bytes([algorithm]) + compressed
+
+
+def decompress(payload: bytes, max_size: int) -> bytes:
+    if len(payload) == 0:
+        raise ValueError("Empty compressed chunk")
+    algorithm = payload[0]
+    if algorithm == STORED:
+        data = payload[1:]
+    elif algorithm in ALGORITHMS:
+        data = ALGORITHMS[algorithm][2](payload[1:], max_size)
+    else:
+        raise ValueError("Unsupported compression " + str(algorithm))
+    if len(data) > max_size:
+        raise ValueError("Chunk larger than the chunk size")
+
+    return data
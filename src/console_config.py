@@ -1,14 +1,32 @@
-from rich.console import Console
-from rich.theme import Theme
-
 # Theme for console text
-console_theme = Theme({
+console_theme = {
     "banner": "bold magenta",
     "header": "bold magenta",
     "error": "bold red",
     "prompt": "bold",
     "default": ""
-})
+}
+
+
+class LazyConsole:
+    # Stands in for the Rich Console and builds it on first use, so modules
+    # can import `console` without scripted runs paying for Rich
+    def __init__(self):
+        object.__setattr__(self, "instance", None)
+
+    def get(self):
+        if self.instance is None:
+            from rich.console import Console
+            from rich.theme import Theme
+            object.__setattr__(self, "instance", Console(theme=Theme(console_theme)))
+        return self.instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
 
 # Configuration for Console
-console = Console(theme=console_theme)
\ No newline at end of file
+console = LazyConsole()
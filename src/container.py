@@ -0,0 +1,614 @@
+import io
+import os
+import struct
+from dataclasses import dataclass
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+
+import compressors
+import engine
+import fileio
+import metrics
+
+# Segmented container layout
+#
+#   header: MAGIC | version (u8) | flags (u8) | chunk_size (u32)
+#   record: nonce (12) | AES-GCM ciphertext of one chunk (+16 byte tag)
+#
+# Every chunk but the last holds exactly chunk_size bytes of plaintext.
+# The header, the chunk index and a final-chunk flag are bound to each
+# record as associated data, so records cannot be reordered, dropped or
+# truncated without failing authentication.
+#
+# Records have a fixed size, so record i starts at HEADER_SIZE + i *
+# record_size and the last one is found from the file size. That is all
+# the index random access needs; a file cut at a record boundary still
+# fails, since its new last record was sealed without the final flag.
+#
+# The low bits of flags name a compression algorithm (see compressors).
+# Chunks of a compressed container are compressed before sealing, and the
+# plaintext of every record starts with the algorithm id that chunk used
+# (0 when it didn't compress and was stored as is). Records no longer have
+# a fixed size, so each is prefixed with the length of its ciphertext:
+#
+#   record: length (u32) | nonce (12) | AES-GCM ciphertext
+#
+# Compressed containers carry FLAG_INDEX. Their last record is followed by
+# a zero length that ends the records and an index of the record lengths,
+# so random access finds record i from one read at the end of the file:
+#
+#   index: 0 (u32) | length of each record (u32) | record count (u64)
+#
+# The index isn't sealed. Every record is still authenticated with its
+# position and final flag, so a forged index can only make reads fail. A
+# compressed header without the flag is rejected, and since the header is
+# in every record's AAD the flag can't be stripped either.
+#
+# With FLAG_ENVELOPE set, records are sealed with a random data key that is
+# stored wrapped by the caller's key between the header and the records:
+#
+#   envelope: slot 0 | slot 1, each nonce (12) | AES-GCM(data key) (32 + 16)
+#
+# Only one slot holds the data key, the other is random. Rewrapping writes
+# the data key under the new key into the spare slot, syncs, and only then
+# overwrites the old slot, so a crash leaves a file one of the two keys
+# opens. Records start after the envelope, and their AAD doesn't cover it,
+# which is why rewrapping never touches them.
+MAGIC = b"LOCKBOX"
+VERSION = 1
+HEADER_FORMAT = ">7sBBI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NONCE_SIZE = 12
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+COMPRESSION_MASK = 0x0F
+FLAG_ENVELOPE = 0x10
+FLAG_INDEX = 0x20
+KEY_SIZE = 32
+WRAPPED_KEY_SIZE = NONCE_SIZE + KEY_SIZE + TAG_SIZE
+KEY_SLOTS = 2
+ENVELOPE_SIZE = KEY_SLOTS * WRAPPED_KEY_SIZE
+LENGTH_FORMAT = ">I"
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+END_OF_RECORDS = struct.pack(LENGTH_FORMAT, 0)
+INDEX_COUNT_FORMAT = ">Q"
+INDEX_COUNT_SIZE = struct.calcsize(INDEX_COUNT_FORMAT)
+
+
+@dataclass
+class Header:
+    version: int
+    flags: int
+    chunk_size: int
+
+    def pack(self) -> bytes:
+        return struct.pack(HEADER_FORMAT, MAGIC, self.version, self.flags, self.chunk_size)
+
+    @property
+    def compression(self) -> int:
+        return self.flags & COMPRESSION_MASK
+
+    @property
+    def envelope(self) -> bool:
+        return bool(self.flags & FLAG_ENVELOPE)
+
+    @property
+    def indexed(self) -> bool:
+        return bool(self.flags & FLAG_INDEX)
+
+    @property
+    def data_offset(self) -> int:
+        # Where the first record starts
+        return HEADER_SIZE + (ENVELOPE_SIZE if self.envelope else 0)
+
+    @property
+    def record_size(self) -> int:
+        # Upper bound for compressed containers, the exact size otherwise
+        if self.compression:
+            return NONCE_SIZE + 1 + self.chunk_size + TAG_SIZE
+        return NONCE_SIZE + self.chunk_size + TAG_SIZE
+
+    def sealed_size(self, plaintext_size: int) -> int:
+        # Size of the records for plaintext_size bytes, header not included
+        records = max(1, -(-plaintext_size // self.chunk_size))
+        return plaintext_size + records * (NONCE_SIZE + TAG_SIZE)
+
+    def opened_size(self, sealed_size: int) -> int:
+        records = max(1, -(-sealed_size // self.record_size))
+        return max(sealed_size - records * (NONCE_SIZE + TAG_SIZE), 0)
+
+
+def is_container(prefix: bytes) -> bool:
+    return len(prefix) >= HEADER_SIZE and prefix[:len(MAGIC)] == MAGIC
+
+
+def parse_header(prefix: bytes) -> Header:
+    magic, version, flags, chunk_size = struct.unpack(
+        HEADER_FORMAT, prefix[:HEADER_SIZE])
+    if magic != MAGIC:
+        raise ValueError("Not a lockbox container")
+    if version != VERSION:
+        raise ValueError("Unsupported container version " + str(version))
+    if chunk_size == 0 or chunk_size > MAX_CHUNK_SIZE:
+        raise ValueError("Invalid chunk size " + str(chunk_size))
+    compression = flags & COMPRESSION_MASK
+    if compression and compression not in compressors.ALGORITHMS:
+        raise ValueError("Unsupported compression " + str(compression))
+    if compression and not flags & FLAG_INDEX:
+        raise ValueError("Compressed container without a record index")
+
+    return Header(version, flags, chunk_size)
+
+
+def chunk_aad(header_bytes: bytes, index: int, final: bool) -> bytes:
+    return header_bytes + struct.pack(">QB", index, final)
+
+
+def wrap_key(key: bytes, data_key: bytes, header_bytes: bytes) -> bytes:
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, data_key, header_bytes)
+
+
+def unwrap_key(key: bytes, envelope: bytes, header_bytes: bytes) -> tuple:
+    # Returns (slot, data key) for the slot key opens, raises InvalidTag
+    # when it opens neither
+    if len(envelope) < ENVELOPE_SIZE:
+        raise ValueError("Truncated envelope")
+    aesgcm = AESGCM(key)
+    for slot in range(KEY_SLOTS):
+        wrapped = envelope[slot * WRAPPED_KEY_SIZE:(slot + 1) * WRAPPED_KEY_SIZE]
+        try:
+            return slot, aesgcm.decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], header_bytes)
+        except InvalidTag:
+            continue
+
+    raise InvalidTag()
+
+
+def new_envelope(key: bytes, header_bytes: bytes) -> tuple:
+    # Returns (data key, envelope) with the data key in slot 0
+    data_key = os.urandom(KEY_SIZE)
+    return data_key, wrap_key(key, data_key, header_bytes) + os.urandom(WRAPPED_KEY_SIZE)
+
+
+def read_data_key(src, key: bytes, header: Header) -> bytes:
+    # Key the records are sealed with; src is positioned just after the
+    # header and is left at the first record
+    if not header.envelope:
+        return key
+
+    return unwrap_key(key, read_full(src, ENVELOPE_SIZE), header.pack())[1]
+
+
+def rewrap(f, old_key: bytes, new_key: bytes) -> bool:
+    # Moves the data key of an envelope container opened "r+b" from old_key
+    # to new_key. Returns False if new_key already opens it
+    f.seek(0)
+    prefix = read_full(f, HEADER_SIZE)
+    header = parse_header(prefix)
+    if not header.envelope:
+        raise ValueError("Not an envelope container")
+    header_bytes = header.pack()
+    envelope = read_full(f, ENVELOPE_SIZE)
+    try:
+        unwrap_key(new_key, envelope, header_bytes)
+        return False
+    except InvalidTag:
+        pass
+    slot, data_key = unwrap_key(old_key, envelope, header_bytes)
+
+    spare = (slot + 1) % KEY_SLOTS
+    for index, wrapped in ((spare, wrap_key(new_key, data_key, header_bytes)),
+                           (slot, os.urandom(WRAPPED_KEY_SIZE))):
+        f.seek(HEADER_SIZE + index * WRAPPED_KEY_SIZE)
+        f.write(wrapped)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return True
+
+
+def read_full(src, size: int) -> bytes:
+    # Pipes may return short reads, keep going until size or EOF
+    buf = src.read(size)
+    if buf is None:
+        buf = b""
+    while len(buf) < size:
+        more = src.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+
+    return buf
+
+
+def seal_chunk(aesgcm: AESGCM, header_bytes: bytes, index: int, final: bool, data: bytes) -> tuple:
+    # Nonce and ciphertext are returned separately and go out in one writev
+    # (see fileio.vector_writer), joining them would copy the whole chunk
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce, aesgcm.encrypt(nonce, data, chunk_aad(header_bytes, index, final))
+
+
+def open_chunk(aesgcm: AESGCM, header_bytes: bytes, index: int, final: bool, record: bytes) -> bytes:
+    if len(record) < NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Truncated record " + str(index))
+    record = memoryview(record)
+    return aesgcm.decrypt(record[:NONCE_SIZE], record[NONCE_SIZE:],
+                          chunk_aad(header_bytes, index, final))
+
+
+def iter_blocks(src, size: int):
+    # Yields (index, final, block) with one block of lookahead so the
+    # final flag is known before the block is sealed or opened
+    current = read_full(src, size)
+    index = 0
+    while True:
+        following = read_full(src, size) if len(current) == size else b""
+        final = len(following) == 0
+        yield index, final, current
+        if final:
+            break
+        current = following
+        index += 1
+
+
+def iter_views(buf: memoryview, size: int):
+    # iter_blocks over a mapped or in-memory buffer. Blocks are slices of
+    # buf, so nothing is copied
+    count = max(1, -(-len(buf) // size))
+    for index in range(count):
+        yield index, index == count - 1, buf[index * size:(index + 1) * size]
+
+
+def record_length(prefix: bytes, max_size: int) -> int:
+    # Bytes of nonce and ciphertext following a record's length prefix
+    if len(prefix) < LENGTH_SIZE:
+        raise ValueError("Truncated record length")
+    (length,) = struct.unpack(LENGTH_FORMAT, prefix)
+    if length < TAG_SIZE or NONCE_SIZE + length > max_size:
+        raise ValueError("Invalid record length " + str(length))
+
+    return NONCE_SIZE + length
+
+
+def pack_index(lengths: list) -> bytes:
+    # The index following END_OF_RECORDS, lengths are of nonce-less records
+    return (struct.pack(">" + str(len(lengths)) + "I", *lengths) +
+            struct.pack(INDEX_COUNT_FORMAT, len(lengths)))
+
+
+def read_record(read, max_size: int) -> bytes:
+    # One length-prefixed record of a compressed container, None at EOF and
+    # b"" at END_OF_RECORDS
+    prefix = read(LENGTH_SIZE)
+    if len(prefix) == 0:
+        return None
+    if prefix == END_OF_RECORDS:
+        return b""
+    length = record_length(prefix, max_size)
+    record = read(length)
+    if len(record) < length:
+        raise ValueError("Truncated record")
+
+    return record
+
+
+def iter_records(src, buf: memoryview, header: Header):
+    # iter_blocks for length-prefixed records, from the mapping when there
+    # is one and from src otherwise. The index has to match the records
+    # read and end the file
+    if buf is None:
+        def read(size):
+            return read_full(src, size)
+    else:
+        position = src.tell()
+
+        def read(size):
+            nonlocal position
+            data = buf[position:position + size]
+            position += len(data)
+            return data
+
+    lengths = list()
+
+    def next_record():
+        record = read_record(read, header.record_size)
+        if record is None:
+            raise ValueError("Truncated container")
+        if len(record) == 0:
+            expected = pack_index(lengths)
+            if bytes(read(len(expected))) != expected or len(read(1)) != 0:
+                raise ValueError("Corrupt record index")
+            return None
+        lengths.append(len(record) - NONCE_SIZE)
+        return record
+
+    current = next_record()
+    if current is None:
+        raise ValueError("Container has no records")
+    index = 0
+    while True:
+        following = next_record()
+        final = following is None
+        yield index, final, current
+        if final:
+            break
+        current = following
+        index += 1
+
+
+def input_blocks(src, buf: memoryview, size: int):
+    # Mapped input starts wherever src was left, e.g. just after the header
+    if buf is None:
+        return iter_blocks(src, size)
+    return iter_views(buf[src.tell():], size)
+
+
+def encrypt_stream(src, dst, key: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   workers: int = engine.DEFAULT_WORKERS,
+                   compression: int = compressors.STORED, progress=None,
+                   envelope: bool = False) -> int:
+    # progress, when given, is called with the input bytes of every chunk
+    # once it has been written
+    flags = compression | (FLAG_INDEX if compression else 0) | (FLAG_ENVELOPE if envelope else 0)
+    header = Header(VERSION, flags, chunk_size)
+    header_bytes = header.pack()
+    if envelope:
+        key, wrapped = new_envelope(key, header_bytes)
+    aesgcm = AESGCM(key)
+
+    def seal(block):
+        index, final, chunk = block
+        data = compressors.compress(compression, chunk) if compression else chunk
+        return seal_chunk(aesgcm, header_bytes, index, final, data), len(chunk)
+
+    # Compression, when on, is timed as part of the AEAD stage
+    seal = metrics.wrap_transform("aead.seal", seal)
+    dst.write(header_bytes)
+    if envelope:
+        dst.write(wrapped)
+    write = metrics.wrap_writev("disk.write", fileio.vector_writer(dst))
+    total = 0
+    lengths = list()
+    with fileio.map_input(src) as buf:
+        # The size of compressed output isn't known up front
+        if buf is not None and not compression:
+            fileio.preallocate(dst, header.sealed_size(len(buf) - src.tell()))
+        blocks = metrics.wrap_blocks("disk.read", input_blocks(src, buf, chunk_size))
+        try:
+            for (nonce, ciphertext), size in engine.ordered_map(seal, blocks, workers):
+                if compression:
+                    write((struct.pack(LENGTH_FORMAT, len(ciphertext)), nonce, ciphertext))
+                    lengths.append(len(ciphertext))
+                else:
+                    write((nonce, ciphertext))
+                total += size
+                if progress is not None:
+                    progress(size)
+        finally:
+            blocks.close()
+        if header.indexed:
+            write((END_OF_RECORDS, pack_index(lengths)))
+        if buf is not None and not compression:
+            fileio.trim(dst)
+
+    return total
+
+
+def decrypt_stream(src, dst, key: bytes, header: Header,
+                   workers: int = engine.DEFAULT_WORKERS, progress=None) -> int:
+    # progress counts input bytes too, i.e. the records consumed
+    header_bytes = header.pack()
+    aesgcm = AESGCM(read_data_key(src, key, header))
+    prefix_size = LENGTH_SIZE if header.compression else 0
+
+    def unseal(block):
+        index, final, record = block
+        chunk = open_chunk(aesgcm, header_bytes, index, final, record)
+        if header.compression:
+            chunk = compressors.decompress(chunk, header.chunk_size)
+        return chunk, prefix_size + len(record)
+
+    unseal = metrics.wrap_transform("aead.open", unseal)
+    write = metrics.wrap_write("disk.write", dst.write)
+    total = 0
+    with fileio.map_input(src) as buf:
+        if header.compression:
+            blocks = iter_records(src, buf, header)
+        else:
+            if buf is not None:
+                fileio.preallocate(dst, header.opened_size(len(buf) - src.tell()))
+            blocks = input_blocks(src, buf, header.record_size)
+        blocks = metrics.wrap_blocks("disk.read", blocks)
+        try:
+            for chunk, consumed in engine.ordered_map(unseal, blocks, workers):
+                write(chunk)
+                total += len(chunk)
+                if progress is not None:
+                    progress(consumed)
+        finally:
+            blocks.close()
+        if buf is not None and not header.compression:
+            fileio.trim(dst)
+
+    return total
+
+
+def reseal_stream(src, dst, old_key: bytes, new_key: bytes, header: Header,
+                  workers: int = engine.DEFAULT_WORKERS) -> int:
+    # Moves a container to another key record by record. Chunks are opened
+    # and sealed again in memory with the same header, index and final flag;
+    # compressed payloads are carried over without decompressing them.
+    # Returns the number of sealed bytes read
+    if header.envelope:
+        raise ValueError("Envelope containers are rewrapped, not resealed")
+    header_bytes = header.pack()
+    old_aesgcm = AESGCM(old_key)
+    new_aesgcm = AESGCM(new_key)
+
+    def reseal(block):
+        index, final, record = block
+        payload = open_chunk(old_aesgcm, header_bytes, index, final, record)
+        return seal_chunk(new_aesgcm, header_bytes, index, final, payload), len(record)
+
+    reseal = metrics.wrap_transform("aead.reseal", reseal)
+    dst.write(header_bytes)
+    write = metrics.wrap_writev("disk.write", fileio.vector_writer(dst))
+    total = 0
+    lengths = list()
+    with fileio.map_input(src) as buf:
+        if header.compression:
+            blocks = iter_records(src, buf, header)
+        else:
+            blocks = input_blocks(src, buf, header.record_size)
+        blocks = metrics.wrap_blocks("disk.read", blocks)
+        try:
+            for (nonce, ciphertext), size in engine.ordered_map(reseal, blocks, workers):
+                if header.compression:
+                    write((struct.pack(LENGTH_FORMAT, len(ciphertext)), nonce, ciphertext))
+                    lengths.append(len(ciphertext))
+                else:
+                    write((nonce, ciphertext))
+                total += size
+        finally:
+            blocks.close()
+        if header.indexed:
+            write((END_OF_RECORDS, pack_index(lengths)))
+
+    return total
+
+
+class EncryptedReader(io.RawIOBase):
+    # Read-only, seekable view of the plaintext of a container. Only the
+    # chunks covering what is read get decrypted, each one authenticated on
+    # its own. Takes ownership of src, which must be seekable
+    def __init__(self, src, key: bytes):
+        super().__init__()
+        self.src = src
+        src.seek(0)
+        prefix = read_full(src, HEADER_SIZE)
+        if not is_container(prefix):
+            raise ValueError("Not a lockbox container")
+        self.header = parse_header(prefix)
+        self.header_bytes = self.header.pack()
+        self.aesgcm = AESGCM(read_data_key(src, key, self.header))
+
+        self.position = 0
+        self.cached_index = -1
+        self.cached_chunk = b""
+
+        sealed = src.seek(0, io.SEEK_END) - self.header.data_offset
+        if self.header.compression:
+            # Every chunk but the last is full, so only the last one has to
+            # be opened to know the plaintext size
+            self.offsets = self.read_index(self.header.data_offset + sealed)
+            self.records = len(self.offsets)
+            self.size = ((self.records - 1) * self.header.chunk_size +
+                         len(self.read_chunk(self.records - 1)))
+        else:
+            self.offsets = None
+            self.records = max(1, -(-sealed // self.header.record_size))
+            self.size = self.header.opened_size(sealed)
+
+    def read_index(self, end: int) -> list:
+        # Offsets of the records, from the index at the end of the file
+        count_offset = end - INDEX_COUNT_SIZE
+        if count_offset < self.header.data_offset:
+            raise ValueError("Truncated container")
+        self.src.seek(count_offset)
+        (count,) = struct.unpack(INDEX_COUNT_FORMAT, read_full(self.src, INDEX_COUNT_SIZE))
+        index_offset = count_offset - (count + 1) * LENGTH_SIZE
+        if count == 0 or index_offset < self.header.data_offset:
+            raise ValueError("Corrupt record index")
+        self.src.seek(index_offset)
+        index = read_full(self.src, (count + 1) * LENGTH_SIZE)
+        if index[:LENGTH_SIZE] != END_OF_RECORDS:
+            raise ValueError("Corrupt record index")
+
+        offsets = list()
+        position = self.header.data_offset
+        for length in struct.unpack(">" + str(count) + "I", index[LENGTH_SIZE:]):
+            offsets.append(position)
+            position += LENGTH_SIZE + NONCE_SIZE + length
+        if position != index_offset:
+            raise ValueError("Corrupt record index")
+
+        return offsets
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence " + str(whence))
+        if position < 0:
+            raise ValueError("Negative seek position " + str(position))
+        self.position = position
+
+        return position
+
+    def read_chunk(self, index: int) -> bytes:
+        if index < 0 or index >= self.records:
+            raise IndexError("Chunk " + str(index) + " out of range")
+        if index != self.cached_index:
+            final = index == self.records - 1
+            if self.offsets is None:
+                self.src.seek(self.header.data_offset + index * self.header.record_size)
+                record = read_full(self.src, self.header.record_size)
+                chunk = open_chunk(self.aesgcm, self.header_bytes, index, final, record)
+            else:
+                self.src.seek(self.offsets[index])
+                record = read_record(lambda size: read_full(self.src, size),
+                                     self.header.record_size)
+                chunk = compressors.decompress(
+                    open_chunk(self.aesgcm, self.header_bytes, index, final, record),
+                    self.header.chunk_size)
+            self.cached_chunk = chunk
+            self.cached_index = index
+
+        return self.cached_chunk
+
+    def readinto(self, b) -> int:
+        if self.position >= self.size:
+            return 0
+        index, start = divmod(self.position, self.header.chunk_size)
+        chunk = self.read_chunk(index)
+        count = min(len(b), len(chunk) - start)
+        b[:count] = memoryview(chunk)[start:start + count]
+        self.position += count
+
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.src.close()
+            self.cached_chunk = b""
+        super().close()
+
+
+def decrypt_range(reader: EncryptedReader, dst, offset: int, length: int) -> int:
+    # Copies plaintext bytes [offset, offset + length) to dst, stopping early
+    # at the end of the file
+    reader.seek(offset)
+    total = 0
+    while total < length:
+        data = reader.read(min(length - total, reader.header.chunk_size))
+        if not data:
+            break
+        dst.write(data)
+        total += len(data)
+
+    return total
@@ -0,0 +1,34 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# AESGCM releases the GIL while it works, so a thread pool is enough to
+# spread chunks across cores
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def ordered_map(fn, items, workers: int = DEFAULT_WORKERS, window: int = 0):
+    # Like map(fn, items) but fans the calls out over a thread pool. Results
+    # are yielded in input order and at most `window` items are in flight,
+    # so a slow writer holds back the reader instead of buffering the file
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    if window <= 0:
+        window = workers * 2
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Stop queued work if the consumer bailed out or a chunk failed
+            for future in pending:
+                future.cancel()
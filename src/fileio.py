@@ -0,0 +1,212 @@
+import errno
+import mmap
+import os
+import stat
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def is_stdio(path) -> bool:
+    # "-" stands for stdin on the input side and stdout on the output side
+    return str(path) == "-"
+
+
+@contextmanager
+def map_input(src):
+    # Read-only mapping of a regular input file, or None when the file can't
+    # be mapped (pipes, sockets, empty files). Slices of the mapping are
+    # memoryviews, so chunks reach the AEAD without being copied
+    try:
+        if src.seekable() and os.fstat(src.fileno()).st_size > 0:
+            buf = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = None
+    except (OSError, ValueError):
+        buf = None
+
+    if buf is None:
+        yield None
+        return
+
+    if hasattr(buf, "madvise"):
+        buf.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(buf)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            buf.close()
+        except BufferError:
+            # A slice is still referenced (e.g. from a traceback), the mapping
+            # goes away with it
+            pass
+
+
+def preallocate(dst, size: int):
+    # Reserve the output up front so the filesystem can lay it out in one
+    # extent and a full disk fails before any work is done
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        if not dst.seekable():
+            return
+        os.posix_fallocate(dst.fileno(), dst.tell(), size)
+    except OSError as err:
+        if err.errno == errno.ENOSPC:
+            raise
+        # Not supported by every filesystem, the writes still work without it
+    except ValueError:
+        pass
+
+
+def trim(dst):
+    # Drops anything preallocate reserved past what was actually written
+    try:
+        if dst.seekable():
+            dst.truncate()
+    except (OSError, ValueError):
+        pass
+
+
+def write_all(fd: int, parts, offset: int = None):
+    # Writes parts back to back with one writev (pwritev at offset) per
+    # call, looping only if the kernel takes less than everything
+    views = [memoryview(part) for part in parts if len(part) > 0]
+    while views:
+        if offset is None:
+            written = os.writev(fd, views)
+        else:
+            written = os.pwritev(fd, views, offset)
+            offset += written
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written > 0:
+            views[0] = views[0][written:]
+
+
+def vector_writer(dst):
+    # Returns write(parts), putting a record's pieces on disk in a single
+    # syscall instead of a small write for the nonce and an unaligned one for
+    # the ciphertext. dst is flushed once and then bypassed, so everything
+    # after this point has to go through write(parts). Streams without a
+    # descriptor (BytesIO) get plain writes
+    try:
+        fd = dst.fileno() if hasattr(os, "writev") else None
+    except (AttributeError, OSError, ValueError):
+        fd = None
+
+    if fd is None:
+        def write(parts):
+            for part in parts:
+                dst.write(part)
+        return write
+
+    dst.flush()
+
+    def write(parts):
+        write_all(fd, parts)
+    return write
+
+
+# fsync policies for outputs: "file" syncs every output before it is renamed
+# into place, "batch" defers the renames of a group of outputs and syncs them
+# together (group commit), "none" leaves flushing to the OS. Outputs are
+# always written to a temp file and renamed, so a crash never leaves a
+# truncated file under the final name.
+FSYNC_POLICIES = ("file", "batch", "none")
+DEFAULT_FSYNC = "file"
+
+
+def sync_dir(path: Path):
+    # Makes a rename in path durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_temp(path: Path) -> tuple:
+    # Exclusive temp file next to path. It is created 0o666 so the kernel
+    # applies the umask and a new output gets the mode open() would give;
+    # an existing output's mode is copied over before the swap
+    while True:
+        tmp = path.with_name("." + path.name + "." + os.urandom(4).hex() + ".tmp")
+        try:
+            return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), tmp
+        except FileExistsError:
+            continue
+
+
+class SyncGroup:
+    # Outputs written under the "batch" policy wait here as temp files. On
+    # commit they are synced back to back, which lets the filesystem fold
+    # them into few journal commits, then renamed, then each directory is
+    # synced once
+    def __init__(self):
+        self.pending = list()
+
+    def add(self, tmp: Path, path: Path):
+        self.pending.append((tmp, path))
+
+    def commit(self):
+        try:
+            for tmp, _ in self.pending:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            for tmp, path in self.pending:
+                os.replace(tmp, path)
+        except BaseException:
+            self.abort()
+            raise
+        for directory in {path.parent for _, path in self.pending}:
+            sync_dir(directory)
+        self.pending.clear()
+
+    def abort(self):
+        for tmp, _ in self.pending:
+            tmp.unlink(missing_ok=True)
+        self.pending.clear()
+
+
+@contextmanager
+def atomic_output(path: Path, fsync: str = "none", group: SyncGroup = None):
+    # Yields a binary file that replaces path once the block completes. On
+    # an exception the temp file is removed and path is left as it was.
+    # "batch" without a group behaves like "file"
+    path = Path(path)
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError("Unknown fsync policy " + str(fsync))
+    if fsync == "batch" and group is None:
+        fsync = "file"
+    if path.exists() and not path.is_file():
+        # Devices and pipes are written directly, there is nothing to replace
+        with open(path, "wb") as f:
+            yield f
+        return
+
+    fd, tmp = open_temp(path)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            if fsync == "file":
+                os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        if fsync == "batch":
+            group.add(tmp, path)
+            return
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if fsync == "file":
+        sync_dir(path.parent)
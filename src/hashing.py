@@ -1,5 +1,11 @@
-import argon2
-from dataclasses import dataclass
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+import metrics
 
 
 @dataclass
@@ -8,13 +14,130 @@ class Argon2Hash:
     version: str
     salt: str
     digest: str
+    memory_cost: int = 0
+    time_cost: int = 0
+    parallelism: int = 0
+
+
+# argon2-cffi's defaults (the RFC 9106 low-memory profile), spelled out so
+# building parameters doesn't import argon2
+DEFAULT_MEMORY_COST = 64 * 1024
+DEFAULT_TIME_COST = 3
+DEFAULT_PARALLELISM = 4
+
+
+@dataclass
+class Argon2Params:
+    # Memory is in KiB, as in the PHC string
+    memory_cost: int = DEFAULT_MEMORY_COST
+    time_cost: int = DEFAULT_TIME_COST
+    parallelism: int = DEFAULT_PARALLELISM
+
+
+# Calibration bounds
+DEFAULT_TARGET_SECONDS = 0.5
+MIN_MEMORY_COST = 64 * 1024
+MAX_MEMORY_COST = 1024 * 1024
+MAX_TIME_COST = 16
+
+# Parameters for new hashes. PasswordHasher holds only its parameters, so
+# one instance is shared; it is built on the first hash or verification,
+# which keeps argon2 out of commands that never use it
+hash_params = Argon2Params()
+password_hasher = None
 
 
+def current_params() -> Argon2Params:
+    return Argon2Params(**asdict(hash_params))
+
+
+def set_params(params: Argon2Params):
+    global hash_params, password_hasher
+    hash_params = Argon2Params(**asdict(params))
+    password_hasher = None
+
+
+def hasher():
+    global password_hasher
+    if password_hasher is None:
+        import argon2
+        password_hasher = argon2.PasswordHasher(time_cost=hash_params.time_cost,
+                                                memory_cost=hash_params.memory_cost,
+                                                parallelism=hash_params.parallelism)
+
+    return password_hasher
+
+
+def load_params(path: Path) -> Argon2Params:
+    # Falls back to the argon2-cffi defaults when nothing was calibrated, or
+    # with a warning when the file is damaged, so the keyring stays usable
+    try:
+        with open(path, "r") as f:
+            params = Argon2Params(**json.load(f))
+        if not all(isinstance(value, int) and value > 0 for value in asdict(params).values()):
+            raise ValueError("costs must be positive integers")
+    except FileNotFoundError:
+        return Argon2Params()
+    except (OSError, ValueError, TypeError) as err:
+        print("lockbox: ignoring Argon2 parameters in " + str(path) + " (" + str(err) +
+              "), using the defaults", file=sys.stderr)
+        return Argon2Params()
+
+    return params
+
+
+def save_params(path: Path, params: Argon2Params):
+    with open(path, "w") as f:
+        json.dump(asdict(params), f)
+
+
+def time_params(params: Argon2Params) -> float:
+    import argon2.low_level
+    start = time.perf_counter()
+    argon2.low_level.hash_secret_raw(
+        b"calibration", os.urandom(16), params.time_cost, params.memory_cost,
+        params.parallelism, 32, argon2.low_level.Type.ID)
+
+    return time.perf_counter() - start
+
+
+def calibrate(target_seconds: float = DEFAULT_TARGET_SECONDS,
+              max_memory_cost: int = MAX_MEMORY_COST) -> Argon2Params:
+    # Memory is what makes Argon2 expensive on GPUs, so it is raised first:
+    # doubled while a hash stays under half the target, then passes are added
+    # while the next one still fits. One lane per core, up to 4 as in RFC 9106.
+    # The start respects max_memory_cost down to the 8 KiB per lane argon2
+    # requires; when even that misses the target it is returned as is
+    lanes = min(os.cpu_count() or 1, 4)
+    params = Argon2Params(max(min(MIN_MEMORY_COST, max_memory_cost), 8 * lanes), 1, lanes)
+    elapsed = time_params(params)
+    while elapsed * 2 <= target_seconds and params.memory_cost * 2 <= max_memory_cost:
+        params.memory_cost *= 2
+        elapsed = time_params(params)
+
+    per_pass = elapsed / params.time_cost
+    while elapsed + per_pass <= target_seconds and params.time_cost < MAX_TIME_COST:
+        params.time_cost += 1
+        elapsed = time_params(params)
+        per_pass = elapsed / params.time_cost
+
+    return params
+
+
+def needs_rehash(argon2_hash: Argon2Hash) -> bool:
+    # Same check as PasswordHasher.check_needs_rehash, on a parsed hash
+    stored = Argon2Params(argon2_hash.memory_cost, argon2_hash.time_cost,
+                          argon2_hash.parallelism)
+
+    return stored != current_params()
+
+
+@metrics.timed("kdf.hash")
 def hash_passphrase(passphrase: str) -> str:
-    ph = argon2.PasswordHasher()
+    import argon2
     try:
-        hash = ph.hash(passphrase)
-    except argon2.exceptions.HashinError as err:
+        hash = hasher().hash(passphrase)
+    except argon2.exceptions.HashingError as err:
         print("Failed to hash passphrase: ", err)
         raise
 
@@ -27,19 +150,22 @@ def parse_argon2_hash(argon2_hash: str) -> Argon2Hash:
 
     argon_variant = tokens[0]
     version = tokens[1].strip('v=')
+    params = dict(param.split('=') for param in tokens[2].split(','))
     salt = tokens[3]
     digest = tokens[4]
 
-    argon2_hash = Argon2Hash(argon_variant, version, salt, digest)
+    argon2_hash = Argon2Hash(argon_variant, version, salt, digest,
+                             int(params['m']), int(params['t']), int(params['p']))
 
     return argon2_hash
 
 
+@metrics.timed("kdf.verify")
 def verify(argon2_hash: str, password: str) -> bool:
-    ph = argon2.PasswordHasher()
-
+    import argon2
     try:
-        ph.verify(argon2_hash, password)
+        hasher().verify(argon2_hash, password)
         return True
-    except argon2.exceptions.VerifyMismatchError:
+    except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+        # A mismatch, or a stored hash argon2 can't read
         return False
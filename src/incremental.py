@@ -0,0 +1,113 @@
+import hashlib
+import hmac
+import json
+import os
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import container
+import engine
+import fileio
+
+# Incremental re-encryption keeps a manifest next to the output:
+#
+#   {"version": 1, "chunk_size": N, "chunks": [[digest, nonce], ...]}
+#
+# with a keyed digest of every plaintext chunk and the nonce of the record
+# that holds it. On the next run a chunk is only sealed again if its digest
+# changed, its final flag changed, or the record on disk no longer carries
+# the recorded nonce (the output was replaced behind the manifest's back).
+# Everything else is left byte for byte as it was.
+#
+# Digests are HMACs under a key derived from the file key, so the manifest
+# doesn't let anyone confirm guesses about the plaintext.
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest"
+
+
+def manifest_path(output: Path) -> Path:
+    return Path(str(output) + MANIFEST_SUFFIX)
+
+
+def digest_key(key: bytes) -> bytes:
+    return hmac.new(key, b"lockbox chunk digest", hashlib.sha256).digest()
+
+
+def load_manifest(path: Path, chunk_size: int) -> list:
+    # Returns the chunk list, or an empty one if there is nothing usable
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("chunk_size") != chunk_size:
+        return []
+
+    return manifest.get("chunks", [])
+
+
+def save_manifest(path: Path, chunk_size: int, chunks: list):
+    # Written next to the target and renamed over it, so a crash leaves the
+    # old manifest or the new one
+    tmp = Path(str(path) + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "chunk_size": chunk_size,
+                   "chunks": chunks}, f)
+    os.replace(tmp, path)
+
+
+def update_stream(src, dst, key: bytes, previous: list,
+                  chunk_size: int = container.DEFAULT_CHUNK_SIZE,
+                  workers: int = engine.DEFAULT_WORKERS, progress=None) -> tuple:
+    # dst is the existing output opened "r+b" (or a new empty file). Returns
+    # (plaintext bytes, chunks rewritten, new manifest chunk list)
+    header = container.Header(container.VERSION, 0, chunk_size)
+    header_bytes = header.pack()
+    aesgcm = AESGCM(key)
+    mac_key = digest_key(key)
+    fd = dst.fileno()
+    if len(previous) > 0 and os.pread(fd, container.HEADER_SIZE, 0) != header_bytes:
+        previous = []
+
+    def process(block):
+        index, final, chunk = block
+        digest = hmac.new(mac_key, chunk, hashlib.sha256).hexdigest()
+        offset = container.HEADER_SIZE + index * header.record_size
+        if index < len(previous):
+            old_digest, old_nonce = previous[index]
+            was_final = index == len(previous) - 1
+            if (old_digest == digest and was_final == final and
+                    os.pread(fd, container.NONCE_SIZE, offset).hex() == old_nonce):
+                return offset, len(chunk), digest, old_nonce, None
+        nonce, ciphertext = container.seal_chunk(aesgcm, header_bytes, index, final, chunk)
+        return offset, len(chunk), digest, nonce.hex(), (nonce, ciphertext)
+
+    if len(previous) == 0:
+        dst.seek(0)
+        dst.write(header_bytes)
+    # Records go straight to their offsets with pwritev from here on
+    dst.flush()
+
+    total = 0
+    rewritten = 0
+    chunks = list()
+    end = container.HEADER_SIZE
+    with fileio.map_input(src) as buf:
+        blocks = container.input_blocks(src, buf, chunk_size)
+        try:
+            for offset, size, digest, nonce, record in engine.ordered_map(process, blocks, workers):
+                if record is not None:
+                    fileio.write_all(fd, record, offset)
+                    rewritten += 1
+                chunks.append([digest, nonce])
+                total += size
+                end = offset + container.NONCE_SIZE + size + container.TAG_SIZE
+                if progress is not None:
+                    progress(size)
+        finally:
+            blocks.close()
+
+    # Drop records past the new end if the plaintext shrank
+    dst.truncate(end)
+
+    return total, rewritten, chunks
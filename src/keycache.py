@@ -0,0 +1,93 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 16
+
+
+def zeroize(buf: bytearray):
+    # Same-length slice assignment overwrites the buffer in place
+    buf[:] = bytes(len(buf))
+
+
+class KeyCache:
+    # Unlocked keys by keyring id, so a key only goes through Argon2 once per
+    # TTL. Keys live in bytearrays that are zeroed when they expire, are
+    # evicted as least recently used, or the cache is cleared
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key_id: int) -> bytes:
+        with self.lock:
+            self.expire()
+            entry = self.entries.get(key_id)
+            if entry is None:
+                metrics.count("keycache.miss")
+                return None
+            metrics.count("keycache.hit")
+            self.entries.move_to_end(key_id)
+            return bytes(entry[0])
+
+    def put(self, key_id: int, key: bytes):
+        with self.lock:
+            self.drop(key_id)
+            self.entries[key_id] = (bytearray(key), time.monotonic() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self.drop(next(iter(self.entries)))
+            self.schedule_sweep()
+
+    def evict(self, key_id: int):
+        with self.lock:
+            self.drop(key_id)
+
+    def clear(self):
+        with self.lock:
+            for key_id in list(self.entries):
+                self.drop(key_id)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    # Callers below hold self.lock
+    def drop(self, key_id: int):
+        entry = self.entries.pop(key_id, None)
+        if entry is not None:
+            zeroize(entry[0])
+
+    def expire(self):
+        now = time.monotonic()
+        for key_id in [key_id for key_id, (_, expires) in self.entries.items()
+                       if expires <= now]:
+            self.drop(key_id)
+
+    def schedule_sweep(self):
+        # Expired keys are wiped even if the cache is never touched again
+        if self.timer is not None or not self.entries:
+            return
+        delay = max(min(expires for _, expires in self.entries.values()) - time.monotonic(), 0)
+        self.timer = threading.Timer(delay, self.sweep)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def sweep(self):
+        with self.lock:
+            self.timer = None
+            self.expire()
+            self.schedule_sweep()
+
+
+# Shared by the interactive menus for the lifetime of the process
+cache = KeyCache()
+atexit.register(cache.clear)
@@ -1,9 +1,133 @@
+import json
 import sqlite3
+import threading
 from dataclasses import dataclass
-from rich.table import Table
+from datetime import datetime
+from pathlib import Path
+from platformdirs import user_data_dir
 
 from console_config import console
 import hashing
+import metrics
+
+# Applied once per connection. WAL lets readers run alongside a writer. In
+# WAL mode NORMAL sync can lose the last commits on power loss, and a key
+# that was reported as added must not disappear, so every commit is synced
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = FULL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+)
+STATEMENT_CACHE_SIZE = 64
+
+# Rows rendered per Rich table or returned per page
+PAGE_SIZE = 100
+
+# Format of the human readable `created` column. The same instant is kept in
+# `created_at` as epoch seconds for range queries
+CREATED_FORMAT = "%m-%d-%y %H:%M:%S"
+
+# Columns shown to users, in display order
+KEY_COLUMNS = "id, created, comments, hash"
+
+# How bulk imports treat rows whose id already exists in the keyring
+INSERT_COLUMNS = "(id, created, comments, hash, created_at, argon_variant, memory_cost, time_cost, parallelism)"
+INSERT_VALUES = "(:id, :created, :comments, :hash, :created_at, :argon_variant, :memory_cost, :time_cost, :parallelism)"
+IMPORT_STATEMENTS = {
+    "abort": "INSERT INTO keyring " + INSERT_COLUMNS + " VALUES" + INSERT_VALUES,
+    "skip": "INSERT OR IGNORE INTO keyring " + INSERT_COLUMNS + " VALUES" + INSERT_VALUES,
+    "replace": "INSERT OR REPLACE INTO keyring " + INSERT_COLUMNS + " VALUES" + INSERT_VALUES,
+    "renumber": "INSERT INTO keyring " + INSERT_COLUMNS + " VALUES" + INSERT_VALUES.replace(":id", "NULL"),
+}
+
+
+def indexed_columns(created: str, argon2_hash: str) -> dict:
+    # Values of the columns derived from `created` and the stored hash.
+    # Anything that does not parse is left NULL rather than rejected
+    columns = {"created_at": None, "argon_variant": None, "memory_cost": None,
+               "time_cost": None, "parallelism": None}
+    try:
+        columns["created_at"] = int(datetime.strptime(created, CREATED_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = hashing.parse_argon2_hash(argon2_hash)
+        columns.update(argon_variant=parsed.argon_variant, memory_cost=parsed.memory_cost,
+                       time_cost=parsed.time_cost, parallelism=parsed.parallelism)
+    except (AttributeError, IndexError, KeyError, ValueError):
+        pass
+
+    return columns
+
+
+def import_row(number: int, line: str) -> dict:
+    # One exported entry, checked before it reaches the database. Raises
+    # ValueError naming the line for anything an export could not contain
+    try:
+        row = json.loads(line)
+    except ValueError as err:
+        raise ValueError("line " + str(number) + ": " + str(err))
+    if not isinstance(row, dict):
+        raise ValueError("line " + str(number) + ": expected a JSON object")
+    if type(row.get("id")) is not int:
+        raise ValueError("line " + str(number) + ": id must be an integer")
+    for field in ("created", "comments", "hash"):
+        if not isinstance(row.get(field), str):
+            raise ValueError("line " + str(number) + ": " + field + " must be a string")
+    try:
+        if not hashing.parse_argon2_hash(row["hash"]).argon_variant.startswith("argon2"):
+            raise ValueError(row["hash"])
+    except (IndexError, KeyError, ValueError):
+        raise ValueError("line " + str(number) + ": hash is not an Argon2 hash")
+
+    row = {field: row[field] for field in ("id", "created", "comments", "hash")}
+    return dict(indexed_columns(row["created"], row["hash"]), **row)
+
+
+def create_keyring_table(conn: sqlite3.Connection):
+    # Original schema, databases from before migrations already have it
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS Keyring(id integer primary key autoincrement, created text, comments text, hash text)")
+
+
+def add_indexed_columns(conn: sqlite3.Connection):
+    conn.execute("DROP INDEX IF EXISTS keyring_created")
+    for column in ("created_at integer", "argon_variant text", "memory_cost integer",
+                   "time_cost integer", "parallelism integer"):
+        conn.execute("ALTER TABLE Keyring ADD COLUMN " + column)
+
+    rows = conn.execute("SELECT id, created, hash FROM Keyring").fetchall()
+    conn.executemany(
+        "UPDATE Keyring SET created_at = :created_at, argon_variant = :argon_variant, "
+        "memory_cost = :memory_cost, time_cost = :time_cost, parallelism = :parallelism "
+        "WHERE id = :id",
+        (dict(indexed_columns(created, hash), id=id) for id, created, hash in rows))
+    conn.execute("CREATE INDEX keyring_created_at ON Keyring(created_at)")
+    conn.execute("CREATE INDEX keyring_params ON Keyring(memory_cost, time_cost, parallelism)")
+
+
+def add_time_cost_index(conn: sqlite3.Connection):
+    # keyring_params leads with memory_cost, so it can't serve --time-below
+    conn.execute("CREATE INDEX keyring_time_cost ON Keyring(time_cost)")
+
+
+# Schema migrations, applied in order. The number of migrations applied is
+# kept in PRAGMA user_version, so add new steps at the end only
+MIGRATIONS = (
+    create_keyring_table,
+    add_indexed_columns,
+    add_time_cost_index,
+)
+
+
+def default_db_path() -> Path:
+    return Path(user_data_dir("lockbox")) / "key-storage"
+
+
+def default_params_path() -> Path:
+    # Calibrated Argon2 parameters used for new keyring entries
+    return Path(user_data_dir("lockbox")) / "argon2.json"
 
 
 @dataclass
@@ -13,118 +137,284 @@ class HashEntry:
     hash: str
 
 
+@dataclass
+class KeyFilter:
+    comment: str = None
+    created_from: datetime = None
+    created_to: datetime = None
+    # Keys hashed with less memory (KiB) or fewer passes than this
+    memory_below: int = None
+    time_below: int = None
+
+    def where(self, after_id: int = 0) -> tuple:
+        # Builds the WHERE clause and parameters for a filtered keyset query
+        clauses = ["id > ?"]
+        params = [after_id]
+        if self.comment:
+            clauses.append("instr(comments, ?) > 0")
+            params.append(self.comment)
+        if self.created_from is not None:
+            clauses.append("created_at >= ?")
+            params.append(int(self.created_from.timestamp()))
+        if self.created_to is not None:
+            clauses.append("created_at < ?")
+            params.append(int(self.created_to.timestamp()))
+        if self.memory_below is not None:
+            clauses.append("memory_cost < ?")
+            params.append(self.memory_below)
+        if self.time_below is not None:
+            clauses.append("time_cost < ?")
+            params.append(self.time_below)
+
+        return " WHERE " + " AND ".join(clauses), params
+
+
 class KeyringDB:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def connect(self) -> sqlite3.Connection:
+        # One connection is opened lazily and kept for the lifetime of the
+        # object. sqlite3 keeps the prepared statements in its cache, so the
+        # fixed queries below are only compiled once
+        if self.conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self.conn = conn
+
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
 
     # Initial setup of key ring database
     def initial_setup(self):
+        self.migrate()
+        return
+
+    def schema_version(self) -> int:
+        with self.lock:
+            return self.connect().execute("PRAGMA user_version").fetchone()[0]
+
+    @metrics.timed("keyring.migrate")
+    def migrate(self) -> int:
+        # Upgrades the database in place. Each step runs in its own
+        # transaction together with the version bump, so an interrupted
+        # upgrade resumes from the last completed step
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                "CREATE TABLE Keyring(id integer primary key autoincrement, created text, comments text, hash text)")
+            with self.lock:
+                conn = self.connect()
+                version = self.schema_version()
+                for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+                    conn.execute("BEGIN")
+                    try:
+                        step(conn)
+                        conn.execute("PRAGMA user_version = " + str(target))
+                    except BaseException:
+                        conn.rollback()
+                        raise
+                    conn.commit()
         except sqlite3.Error as err:
             print("sqlite3 error: ", err)
             raise
-        finally:
-            if conn:
-                conn.close()
-        return
 
+        return len(MIGRATIONS)
+
+    @metrics.timed("keyring.get_valid_ids")
     def get_valid_ids(self) -> list:
+        valid_ids = list()
         try:
-            conn = sqlite3.connect(
-                'file:' + str(self.db_path) + '?mode=ro', uri=True)
-            cursor = conn.execute("SELECT id FROM Keyring")
-            res = cursor.fetchall()
-            valid_ids = list()
-
-            for id in res:
-                valid_ids.append(id[0])
+            with self.lock:
+                cursor = self.connect().execute("SELECT id FROM Keyring")
+                for id in cursor:
+                    valid_ids.append(id[0])
         except sqlite3.Error as err:
             print("Error getting key IDs from database: ", err)
-        finally:
-            if conn:
-                conn.close()
 
         return valid_ids
 
-    def store_hash(self, hash_entry: HashEntry) -> int:
+    @metrics.timed("keyring.key_exists")
+    def key_exists(self, id: int) -> bool:
         try:
-            conn = sqlite3.connect(self.db_path)
-            new_entry = [
-                (None, hash_entry.date, hash_entry.comments, hash_entry.hash)]
-            conn.execute(
-                "INSERT INTO keyring VALUES(?, ?, ?, ?)", new_entry[0])
-            conn.commit()
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT EXISTS(SELECT 1 FROM keyring WHERE id = ?)", (id,))
+                return bool(cursor.fetchone()[0])
         except sqlite3.Error as err:
-            print("Error inserting new hash: ", err)
-            return -1
-        finally:
-            if conn:
-                conn.close()
+            print("Error checking key ID: ", err)
+            return False
 
-        return 0
+    @metrics.timed("keyring.has_keys")
+    def has_keys(self) -> bool:
+        try:
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT EXISTS(SELECT 1 FROM keyring)")
+                return bool(cursor.fetchone()[0])
+        except sqlite3.Error as err:
+            print("Error checking for stored keys: ", err)
+            return False
 
-    def dump_keys(self) -> int:
+    @metrics.timed("keyring.list_keys")
+    def list_keys(self, after_id: int = 0, limit: int = PAGE_SIZE,
+                  key_filter: KeyFilter = None) -> list:
+        # Keyset pagination: pass the last id of a page as after_id to get
+        # the next one, so every page is an index range scan on the primary key
+        where, params = (key_filter or KeyFilter()).where(after_id)
         try:
-            conn = sqlite3.connect(
-                'file:' + str(self.db_path) + '?mode=ro', uri=True)
-            cursor = conn.execute("SELECT * FROM keyring")
-            hashes = cursor.fetchall()
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT " + KEY_COLUMNS + " FROM keyring" + where + " ORDER BY id LIMIT ?",
+                    params + [limit])
+                return cursor.fetchall()
         except sqlite3.Error as err:
             print("Error getting hashes from database: ", err)
+            return []
+
+    @metrics.timed("keyring.store_hash")
+    def store_hash(self, hash_entry: HashEntry) -> int:
+        try:
+            with self.lock, self.connect() as conn:
+                conn.execute(
+                    IMPORT_STATEMENTS["renumber"],
+                    dict(indexed_columns(hash_entry.date, hash_entry.hash),
+                         created=hash_entry.date, comments=hash_entry.comments,
+                         hash=hash_entry.hash))
+        except sqlite3.Error as err:
+            print("Error inserting new hash: ", err)
             return -1
-        finally:
-            if conn:
-                conn.close()
 
-        table = Table()
-        table.add_column("ID", justify="left", style="header")
-        table.add_column("Created", justify="left", style="header")
-        table.add_column("Comments", justify="left", style="header")
-        table.add_column("Hash", justify="left", style="header")
+        return 0
 
-        if hashes:
+    @metrics.timed("keyring.dump_keys")
+    def dump_keys(self, key_filter: KeyFilter = None) -> int:
+        # Renders one table per page so output starts right away and only a
+        # page of rows is held at a time. Rich is only loaded when rendering
+        from rich.table import Table
+        after_id = 0
+        while True:
+            hashes = self.list_keys(after_id, PAGE_SIZE, key_filter)
+            if not hashes:
+                break
+
+            table = Table()
+            table.add_column("ID", justify="left", style="header")
+            table.add_column("Created", justify="left", style="header")
+            table.add_column("Comments", justify="left", style="header")
+            table.add_column("Hash", justify="left", style="header")
             for entry in hashes:
                 id, created, comments, hash = entry
                 table.add_row(str(id), created, comments, hash)
-            console.print("Hashes in Keyring\n" + "-" * 15,
-                          justify="left", style="header")
+
+            if after_id == 0:
+                console.print("Hashes in Keyring\n" + "-" * 15,
+                              justify="left", style="header")
             console.print(table)
+            after_id = hashes[-1][0]
 
         return 0
 
-    def verify_hash(self, input: str, hash_id: id) -> bool:
+    def iter_keys(self, key_filter: KeyFilter = None, after_id: int = 0):
+        # Streams rows from the cursor instead of loading the whole keyring.
+        # Uses its own cursor so other calls can run between rows
+        where, params = (key_filter or KeyFilter()).where(after_id)
         try:
-            conn = sqlite3.connect(
-                'file:' + str(self.db_path) + '?mode=ro', uri=True)
-            cursor = conn.execute(
-                "SELECT hash from keyring WHERE id = ?", (hash_id,))
-            argon2_hash = cursor.fetchone()[0]
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT " + KEY_COLUMNS + " FROM keyring" + where + " ORDER BY id", params)
+            yield from cursor
         except sqlite3.Error as err:
-            print("Error fetching hash from database: ", err)
+            print("Error getting hashes from database: ", err)
+
+    @metrics.timed("keyring.export_entries")
+    def export_entries(self, dst) -> int:
+        # Writes one JSON object per line, straight from the cursor
+        count = 0
+        for id, created, comments, hash in self.iter_keys():
+            dst.write(json.dumps({"id": id, "created": created,
+                                  "comments": comments, "hash": hash}) + "\n")
+            count += 1
+
+        return count
+
+    @metrics.timed("keyring.import_entries")
+    def import_entries(self, src, on_conflict: str = "abort") -> int:
+        # All rows go in with executemany inside a single transaction, so the
+        # import costs one commit and fails as a whole. A bad row raises from
+        # inside executemany, which rolls back the rows before it
+        statement = IMPORT_STATEMENTS[on_conflict]
+        rows = (import_row(number, line) for number, line in enumerate(src, 1) if line.strip())
+        try:
+            with self.lock, self.connect() as conn:
+                cursor = conn.executemany(statement, rows)
+        except (sqlite3.Error, ValueError) as err:
+            print("Unable to import keys: ", err)
+            return -1
+
+        return cursor.rowcount
+
+    def verify_hash(self, input: str, hash_id: id) -> bool:
+        argon2_hash = self.fetch_hash(hash_id)
+        if not argon2_hash:
             return False
-        finally:
-            if conn:
-                conn.close()
 
         return hashing.verify(argon2_hash, input)
 
+    @metrics.timed("keyring.unlock_hash")
+    def unlock_hash(self, hash_id: int, passphrase: str) -> hashing.Argon2Hash:
+        # One SELECT and one Argon2 verification per key use. Returns None
+        # for an unknown id or a wrong passphrase
+        argon2_hash = self.fetch_hash(hash_id)
+        if not argon2_hash or not hashing.verify(argon2_hash, passphrase):
+            return None
+
+        return hashing.parse_argon2_hash(argon2_hash)
+
+    @metrics.timed("keyring.rehash")
+    def rehash(self, hash_id: int, passphrase: str) -> int:
+        # The Argon2 digest is the file key, so the stored entry can't be
+        # rehashed in place without orphaning files encrypted under it.
+        # Instead a new entry with the current parameters is added next to it
+        res = None
+        try:
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT comments, hash FROM keyring WHERE id = ?", (hash_id,))
+                res = cursor.fetchone()
+        except sqlite3.Error as err:
+            print("Error fetching hash from database: ", err)
+        if not res or not hashing.verify(res[1], passphrase):
+            return -1
+
+        hash_entry = HashEntry(date=datetime.now().strftime(CREATED_FORMAT),
+                               comments="rehash of #" + str(hash_id) + ": " + res[0],
+                               hash=hashing.hash_passphrase(passphrase))
+
+        return self.store_hash(hash_entry)
+
+    @metrics.timed("keyring.fetch_hash")
     def fetch_hash(self, id: int) -> str:
         try:
-            conn = sqlite3.connect(
-                'file:' + str(self.db_path) + '?mode=ro', uri=True)
-            cursor = conn.execute(
-                "SELECT hash FROM keyring WHERE id = ?", (id,))
-            res = cursor.fetchone()
+            with self.lock:
+                cursor = self.connect().execute(
+                    "SELECT hash FROM keyring WHERE id = ?", (id,))
+                res = cursor.fetchone()
         except sqlite3.Error as err:
             print("Error fetching hash from database: ", err)
             return ""
-        finally:
-            if conn:
-                conn.close()
 
         if not res:
             return ""
@@ -133,33 +423,25 @@ class KeyringDB:
 
         return hash
 
+    @metrics.timed("keyring.delete_hash")
     def delete_hash(self, id: int) -> int:
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.execute("DELETE FROM keyring WHERE id = ?", (id,))
-            conn.commit()
-            console.print("(+) Deleted hash #" + str(id),
-                          justify="left", style="header")
+            with self.lock, self.connect() as conn:
+                conn.execute("DELETE FROM keyring WHERE id = ?", (id,))
         except sqlite3.Error as err:
             print("Unable to delete key: ", err)
             return -1
-        finally:
-            if conn:
-                conn.close()
 
         return 0
 
+    @metrics.timed("keyring.edit_comments")
     def edit_comments(self, update: list) -> int:
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.execute(
-                "UPDATE keyring SET comments = ? WHERE id = ?", update)
-            conn.commit()
+            with self.lock, self.connect() as conn:
+                conn.execute(
+                    "UPDATE keyring SET comments = ? WHERE id = ?", update)
         except sqlite3.Error as err:
             print("Unable to update comments: ", err)
             return -1
-        finally:
-            if conn:
-                conn.close()
 
         return 0
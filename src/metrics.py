@@ -0,0 +1,217 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Timers, call counts and bytes per stage of the hot paths: KDF, keyring
+# queries, disk reads and writes and the AEAD pass. Collection is off until
+# enable() is called. While it is off, wrap_* hand back the function they
+# were given, so per-chunk paths run exactly the code they would without
+# instrumentation, and timed() adds one flag check per call.
+#
+# Stage names are dotted, e.g. "aead.seal", "disk.write", "kdf.verify",
+# "keyring.list_keys". Times from worker threads add up, so a stage can
+# report more seconds than the run took. Counters track events that have
+# no duration of their own, e.g. "keycache.hit", "incremental.chunks_reused",
+# "rotate.rewrapped".
+PROFILE_MODES = ("cprofile", "tracemalloc")
+TRACEMALLOC_TOP = 25
+
+
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.counters = dict()
+
+    def record(self, stage: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                              "bytes_in": 0, "bytes_out": 0}
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+stats = Stats()
+
+
+def enable():
+    stats.enabled = True
+
+
+def disable():
+    stats.enabled = False
+
+
+def reset():
+    with stats.lock:
+        stats.stages.clear()
+        stats.counters.clear()
+
+
+def count(name: str, value: int = 1):
+    if stats.enabled:
+        stats.count(name, value)
+
+
+def timed(stage: str, returns_bytes: bool = False):
+    # Decorator for coarse calls (a file, a query, a KDF run). With
+    # returns_bytes the return value is counted as bytes processed
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            size = result if returns_bytes and isinstance(result, int) else 0
+            stats.record(stage, time.perf_counter() - start, size, size)
+            return result
+        return wrapper
+
+    return decorator
+
+
+def wrap_transform(stage: str, fn):
+    # For fn(block) -> result on the chunk path, bytes are the length of
+    # the block's data going in
+    if not stats.enabled:
+        return fn
+
+    def wrapper(block):
+        start = time.perf_counter()
+        result = fn(block)
+        stats.record(stage, time.perf_counter() - start, len(block[2]))
+        return result
+
+    return wrapper
+
+
+def wrap_write(stage: str, write):
+    if not stats.enabled:
+        return write
+
+    def wrapper(data):
+        start = time.perf_counter()
+        written = write(data)
+        stats.record(stage, time.perf_counter() - start, 0, len(data))
+        return written
+
+    return wrapper
+
+
+def wrap_writev(stage: str, write):
+    # wrap_write for write(parts), bytes are those of all the parts
+    if not stats.enabled:
+        return write
+
+    def wrapper(parts):
+        start = time.perf_counter()
+        written = write(parts)
+        stats.record(stage, time.perf_counter() - start, 0, sum(len(part) for part in parts))
+        return written
+
+    return wrapper
+
+
+def wrap_blocks(stage: str, blocks):
+    # Times producing each (index, final, block) from the input. Mapped
+    # input is paged in lazily, so for it this mostly measures slicing and
+    # the page faults show up in the AEAD stage instead
+    if not stats.enabled:
+        return blocks
+
+    def generator():
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    block = next(blocks)
+                except StopIteration:
+                    return
+                stats.record(stage, time.perf_counter() - start, len(block[2]))
+                yield block
+        finally:
+            blocks.close()
+
+    return generator()
+
+
+def snapshot() -> dict:
+    with stats.lock:
+        return {"stages": {stage: dict(entry) for stage, entry in stats.stages.items()},
+                "counters": dict(stats.counters)}
+
+
+def to_json() -> str:
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+def to_prometheus() -> str:
+    # Prometheus text exposition format
+    data = snapshot()
+    lines = list()
+    families = (
+        ("lockbox_stage_calls_total", "counter", "Calls per stage", "calls"),
+        ("lockbox_stage_seconds_total", "counter", "Seconds spent per stage", "seconds"),
+        ("lockbox_stage_max_seconds", "gauge", "Longest single call per stage", "max_seconds"),
+        ("lockbox_stage_bytes_in_total", "counter", "Bytes into each stage", "bytes_in"),
+        ("lockbox_stage_bytes_out_total", "counter", "Bytes out of each stage", "bytes_out"),
+    )
+    for name, kind, help, field in families:
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " " + kind)
+        for stage, entry in sorted(data["stages"].items()):
+            lines.append(name + '{stage="' + stage + '"} ' + repr(entry[field]))
+    if data["counters"]:
+        lines.append("# HELP lockbox_events_total Event counters")
+        lines.append("# TYPE lockbox_events_total counter")
+        for counter, value in sorted(data["counters"].items()):
+            lines.append('lockbox_events_total{name="' + counter + '"} ' + str(value))
+
+    return "\n".join(lines) + "\n"
+
+
+def export(fmt: str = "json") -> str:
+    return to_prometheus() if fmt == "prometheus" else to_json() + "\n"
+
+
+@contextmanager
+def profile(mode: str, output: str):
+    # cProfile only sees the calling thread, run with --workers 1 to get
+    # the chunk path into the profile. tracemalloc follows every thread
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output)
+    elif mode == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(output, "w") as f:
+                f.write("current " + str(current) + " B, peak " + str(peak) + " B\n")
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                    f.write(str(stat) + "\n")
+    else:
+        raise ValueError("Unknown profile mode " + str(mode))
@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+
+# Progress of a single file operation, fed with the input bytes each chunk
+# consumed. The chunk loop only adds to a counter and compares a clock;
+# snapshots go to the renderer at most once per interval, so a slow
+# terminal never holds up the loop.
+BAR_INTERVAL = 0.1
+LINE_INTERVAL = 1.0
+
+
+@dataclass
+class ProgressEvent:
+    done: int
+    total: int
+    elapsed: float
+    bytes_per_sec: float
+    eta: float
+    final: bool
+
+
+class Progress:
+    def __init__(self, total: int, render, interval: float):
+        self.total = total
+        self.render = render
+        self.interval = interval
+        self.done = 0
+        self.start = time.monotonic()
+        self.next_update = self.start + interval
+
+    def __call__(self, size: int):
+        self.done += size
+        now = time.monotonic()
+        if now >= self.next_update:
+            self.next_update = now + self.interval
+            self.render(self.event(now, False))
+
+    def event(self, now: float, final: bool) -> ProgressEvent:
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.done, 0) / rate
+
+        return ProgressEvent(self.done, self.total, elapsed, rate, eta, final)
+
+    def finish(self):
+        self.render(self.event(time.monotonic(), True))
+
+
+def input_size(path) -> int:
+    # Size of a regular input file, None for stdin and pipes
+    try:
+        if str(path) != "-" and os.path.isfile(path):
+            return os.path.getsize(path)
+    except OSError:
+        pass
+
+    return None
+
+
+@contextmanager
+def lines(total: int, operation: str, file=None):
+    # Scripted mode: one JSON object per line, at most once a second plus a
+    # final line, e.g. {"op": "encrypt", "done": ..., "bytes_per_sec": ...}
+    file = file if file is not None else sys.stderr
+
+    def render(event: ProgressEvent):
+        file.write(json.dumps(dict(op=operation, **asdict(event))) + "\n")
+        file.flush()
+
+    report = Progress(total, render, LINE_INTERVAL)
+    yield report
+    report.finish()
+
+
+@contextmanager
+def bar(total: int, description: str):
+    # Interactive mode: a Rich bar with throughput and ETA. Drawn on stderr,
+    # so it never mixes with data written to stdout
+    from rich.console import Console
+    from rich.progress import (Progress as RichProgress, BarColumn, DownloadColumn,
+                               TextColumn, TimeRemainingColumn, TransferSpeedColumn)
+
+    with RichProgress(TextColumn("{task.description}"), BarColumn(), DownloadColumn(),
+                      TransferSpeedColumn(), TimeRemainingColumn(),
+                      console=Console(stderr=True), transient=True) as rich_progress:
+        task = rich_progress.add_task(description, total=total)
+
+        def render(event: ProgressEvent):
+            rich_progress.update(task, completed=event.done)
+
+        report = Progress(total, render, BAR_INTERVAL)
+        yield report
+        report.finish()
@@ -0,0 +1,140 @@
+import io
+import json
+import os
+import time
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+
+from batch import BatchResult, collect_files
+import container
+import engine
+import fileio
+import metrics
+
+# Key rotation moves encrypted files from one keyring entry to another in
+# place. Envelope containers only get their data key rewrapped in the
+# header. Other files are resealed chunk by chunk into a temporary file
+# next to them, synced and renamed over the original, so plaintext never
+# touches disk and a crash leaves either the old or the new file.
+#
+# Finished files are appended to a journal, one JSON object per line:
+#
+#   {"path": "/abs/path", "bytes": 1234}
+#
+# Running the same rotation again skips everything in the journal. A file
+# that was renamed into place just before a crash but never journaled is
+# recognised by opening its first chunk with the new key. The journal is
+# removed once a run finishes without failures.
+
+
+def expand_paths(paths: list) -> list:
+    # Directories stand for every file below them
+    files = list()
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(collect_files(path))
+        else:
+            files.append(path)
+
+    return files
+
+
+def load_journal(journal: Path) -> set:
+    done = set()
+    try:
+        with open(journal, "r") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except (ValueError, KeyError):
+                    # A line cut short by a crash, its file is checked again
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return done
+
+
+def sealed_with(path: Path, key: bytes) -> bool:
+    # True when the file is a container whose first chunk opens with key
+    try:
+        with open(path, "rb") as src:
+            with container.EncryptedReader(src, key) as reader:
+                reader.read_chunk(0)
+    except (OSError, ValueError, InvalidTag):
+        return False
+
+    return True
+
+
+def rewrap_file(path: Path, old_key: bytes, new_key: bytes) -> bool:
+    # True for an envelope container, which then is under new_key
+    with open(path, "r+b") as f:
+        prefix = container.read_full(f, container.HEADER_SIZE)
+        if not container.is_container(prefix) or not container.parse_header(prefix).envelope:
+            return False
+        container.rewrap(f, old_key, new_key)
+
+    return True
+
+
+def reseal_file(path: Path, old_key: bytes, new_key: bytes, workers: int = 1) -> int:
+    # Atomically replaces path with the same plaintext under new_key.
+    # Returns the number of bytes rewritten
+    path = Path(path)
+    if rewrap_file(path, old_key, new_key):
+        metrics.count("rotate.rewrapped")
+        return container.ENVELOPE_SIZE
+    with open(path, "rb") as src, fileio.atomic_output(path, "file") as dst:
+        prefix = container.read_full(src, container.HEADER_SIZE)
+        if container.is_container(prefix):
+            header = container.parse_header(prefix)
+            total = container.reseal_stream(src, dst, old_key, new_key, header, workers)
+        else:
+            # Files from before the container format are one AEAD
+            # message, they come out as containers
+            data = memoryview(prefix + src.read())
+            cleartext = AESGCM(old_key).decrypt(data[:12], data[12:], None)
+            container.encrypt_stream(io.BytesIO(cleartext), dst, new_key, workers=workers)
+            total = len(data)
+    metrics.count("rotate.resealed")
+
+    return total
+
+
+def rotate_files(paths: list, old_key: bytes, new_key: bytes, journal: Path,
+                 workers: int = engine.DEFAULT_WORKERS) -> BatchResult:
+    # Files run side by side, each on a single thread
+    result = BatchResult()
+    done = load_journal(journal)
+    todo = [path for path in expand_paths(paths) if str(path.resolve()) not in done]
+
+    def job(path: Path) -> tuple:
+        try:
+            return path, reseal_file(path, old_key, new_key), None
+        except InvalidTag as err:
+            if sealed_with(path, new_key):
+                return path, 0, None
+            return path, 0, err
+        except (OSError, ValueError) as err:
+            return path, 0, err
+
+    start = time.perf_counter()
+    with open(journal, "a") as f:
+        for path, size, err in engine.ordered_map(job, todo, workers):
+            if err is not None:
+                result.failures.append((path, err))
+                continue
+            f.write(json.dumps({"path": str(path.resolve()), "bytes": size}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            result.files += 1
+            result.bytes += size
+    result.elapsed = time.perf_counter() - start
+
+    if not result.failures:
+        journal.unlink(missing_ok=True)
+
+    return result
@@ -0,0 +1,256 @@
+import io
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import ciphers  # noqa: E402
+import compressors  # noqa: E402
+import container  # noqa: E402
+import rotate  # noqa: E402
+
+# Round trips and tamper checks for the segmented container and its
+# compressed, envelope, incremental and rotated variants:
+#
+#   python3 -m unittest discover tests
+CHUNK = 1024
+SIZES = (0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 3 * CHUNK, 3 * CHUNK + 1)
+VARIANTS = (
+    ("plain", compressors.STORED, False),
+    ("zlib", compressors.ZLIB, False),
+    ("envelope", compressors.STORED, True),
+    ("zlib-envelope", compressors.ZLIB, True),
+)
+REJECTED = (InvalidTag, ValueError)
+
+
+def plaintext(size: int) -> bytes:
+    # Half random, half repeated, so compressed chunks come in both kinds
+    return (os.urandom(size // 2) + b"lockbox" * size)[:size]
+
+
+def seal(data: bytes, key: bytes, compression: int = compressors.STORED,
+         envelope: bool = False) -> bytes:
+    dst = io.BytesIO()
+    container.encrypt_stream(io.BytesIO(data), dst, key, CHUNK, 2, compression,
+                             envelope=envelope)
+    return dst.getvalue()
+
+
+def unseal(sealed: bytes, key: bytes) -> bytes:
+    src = io.BytesIO(sealed)
+    header = container.parse_header(container.read_full(src, container.HEADER_SIZE))
+    dst = io.BytesIO()
+    container.decrypt_stream(src, dst, key, header, 2)
+    return dst.getvalue()
+
+
+def read_range(sealed: bytes, key: bytes, offset: int, length: int) -> bytes:
+    dst = io.BytesIO()
+    with container.EncryptedReader(io.BytesIO(sealed), key) as reader:
+        container.decrypt_range(reader, dst, offset, length)
+    return dst.getvalue()
+
+
+def split_records(sealed: bytes) -> tuple:
+    # (prefix before the first record, records with their length prefixes,
+    # header) of a container
+    header = container.parse_header(sealed)
+    start = header.data_offset
+    if not header.compression:
+        body = sealed[start:]
+        records = [body[i:i + header.record_size] for i in range(0, len(body), header.record_size)]
+        return sealed[:start], records, header
+
+    records = list()
+    position = start
+    while True:
+        (length,) = struct.unpack(container.LENGTH_FORMAT,
+                                  sealed[position:position + container.LENGTH_SIZE])
+        if length == 0:
+            break
+        end = position + container.LENGTH_SIZE + container.NONCE_SIZE + length
+        records.append(sealed[position:end])
+        position = end
+        if position == len(sealed):
+            break
+
+    return sealed[:start], records, header
+
+
+def join_records(prefix: bytes, records: list, header: container.Header) -> bytes:
+    # Reassembles a container, with a matching index when it has one
+    body = prefix + b"".join(records)
+    if header.indexed:
+        lengths = [len(record) - container.LENGTH_SIZE - container.NONCE_SIZE
+                   for record in records]
+        body += container.END_OF_RECORDS + container.pack_index(lengths)
+    return body
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.key = os.urandom(container.KEY_SIZE)
+
+    def test_round_trip(self):
+        for name, compression, envelope in VARIANTS:
+            for size in SIZES:
+                with self.subTest(variant=name, size=size):
+                    data = plaintext(size)
+                    sealed = seal(data, self.key, compression, envelope)
+                    self.assertEqual(unseal(sealed, self.key), data)
+                    self.assertEqual(read_range(sealed, self.key, 0, size + 1), data)
+
+    def test_ranges(self):
+        data = plaintext(5 * CHUNK + 17)
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(data, self.key, compression, envelope)
+            for offset, length in ((0, 1), (CHUNK - 1, 2), (2 * CHUNK, CHUNK),
+                                   (3 * CHUNK + 5, 4 * CHUNK), (len(data), 10)):
+                with self.subTest(variant=name, offset=offset, length=length):
+                    self.assertEqual(read_range(sealed, self.key, offset, length),
+                                     data[offset:offset + length])
+
+    def test_files(self):
+        # Goes through the vectored writes and the atomic output
+        data = plaintext(3 * CHUNK + 1)
+        with tempfile.TemporaryDirectory() as workdir:
+            source = Path(workdir) / "plain"
+            sealed = Path(workdir) / "sealed"
+            opened = Path(workdir) / "opened"
+            source.write_bytes(data)
+            for name, compression, envelope in VARIANTS:
+                with self.subTest(variant=name):
+                    algorithm = None if compression == compressors.STORED else name.split("-")[0]
+                    ciphers.encrypt_file(source, self.key, sealed, CHUNK, 2, algorithm,
+                                         envelope=envelope)
+                    ciphers.decrypt_file(sealed, self.key, opened, 2)
+                    self.assertEqual(opened.read_bytes(), data)
+            self.assertEqual(sorted(os.listdir(workdir)), ["opened", "plain", "sealed"])
+
+    def test_legacy(self):
+        # Files from before the container format are nonce || ciphertext
+        data = plaintext(3 * CHUNK)
+        nonce = os.urandom(container.NONCE_SIZE)
+        with tempfile.TemporaryDirectory() as workdir:
+            legacy = Path(workdir) / "legacy"
+            opened = Path(workdir) / "opened"
+            legacy.write_bytes(nonce + AESGCM(self.key).encrypt(nonce, data, None))
+            ciphers.decrypt_file(legacy, self.key, opened)
+            self.assertEqual(opened.read_bytes(), data)
+
+            with self.assertRaises(InvalidTag):
+                ciphers.decrypt_file(legacy, os.urandom(container.KEY_SIZE), opened)
+            self.assertEqual(opened.read_bytes(), data)
+
+    def test_incremental(self):
+        data = bytearray(plaintext(4 * CHUNK + 3))
+        with tempfile.TemporaryDirectory() as workdir:
+            source = Path(workdir) / "plain"
+            sealed = Path(workdir) / "sealed"
+            opened = Path(workdir) / "opened"
+            source.write_bytes(data)
+            _, rewritten, chunks = ciphers.encrypt_file_incremental(source, self.key, sealed, CHUNK)
+            self.assertEqual(rewritten, chunks)
+
+            data[2 * CHUNK] ^= 1
+            source.write_bytes(data)
+            _, rewritten, chunks = ciphers.encrypt_file_incremental(source, self.key, sealed, CHUNK)
+            self.assertEqual((rewritten, chunks), (1, 5))
+            ciphers.decrypt_file(sealed, self.key, opened)
+            self.assertEqual(opened.read_bytes(), data)
+
+            source.write_bytes(data[:CHUNK + 1])
+            ciphers.encrypt_file_incremental(source, self.key, sealed, CHUNK)
+            ciphers.decrypt_file(sealed, self.key, opened)
+            self.assertEqual(opened.read_bytes(), data[:CHUNK + 1])
+
+    def test_rotate(self):
+        data = plaintext(3 * CHUNK + 1)
+        new_key = os.urandom(container.KEY_SIZE)
+        with tempfile.TemporaryDirectory() as workdir:
+            path = Path(workdir) / "sealed"
+            for name, compression, envelope in VARIANTS:
+                with self.subTest(variant=name):
+                    path.write_bytes(seal(data, self.key, compression, envelope))
+                    rewritten = rotate.reseal_file(path, self.key, new_key)
+                    if envelope:
+                        self.assertEqual(rewritten, container.ENVELOPE_SIZE)
+                    self.assertEqual(unseal(path.read_bytes(), new_key), data)
+                    with self.assertRaises(InvalidTag):
+                        unseal(path.read_bytes(), self.key)
+
+
+class TamperTest(unittest.TestCase):
+    def setUp(self):
+        self.key = os.urandom(container.KEY_SIZE)
+        self.data = plaintext(4 * CHUNK + 100)
+
+    def assertRejected(self, sealed: bytes, key: bytes = None):
+        key = key if key is not None else self.key
+        with self.assertRaises(REJECTED):
+            unseal(sealed, key)
+        with self.assertRaises(REJECTED):
+            read_range(sealed, key, 0, len(self.data))
+
+    def test_truncated_at_record_boundary(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(self.data, self.key, compression, envelope)
+            prefix, records, header = split_records(sealed)
+            for count in range(1, len(records)):
+                with self.subTest(variant=name, records=count):
+                    self.assertRejected(prefix + b"".join(records[:count]))
+                    # Also with a well-formed index for the records kept
+                    self.assertRejected(join_records(prefix, records[:count], header))
+
+    def test_truncated_mid_record(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(self.data, self.key, compression, envelope)
+            with self.subTest(variant=name):
+                self.assertRejected(sealed[:-1])
+                self.assertRejected(sealed[:len(sealed) // 2])
+
+    def test_reordered_records(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(self.data, self.key, compression, envelope)
+            prefix, records, header = split_records(sealed)
+            records[1], records[2] = records[2], records[1]
+            with self.subTest(variant=name):
+                self.assertRejected(join_records(prefix, records, header))
+
+    def test_appended_bytes(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(self.data, self.key, compression, envelope)
+            with self.subTest(variant=name):
+                self.assertRejected(sealed + b"\x00")
+                self.assertRejected(sealed + sealed[container.HEADER_SIZE:])
+
+    def test_wrong_key(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = seal(self.data, self.key, compression, envelope)
+            with self.subTest(variant=name):
+                self.assertRejected(sealed, os.urandom(container.KEY_SIZE))
+
+    def test_flipped_bit(self):
+        for name, compression, envelope in VARIANTS:
+            sealed = bytearray(seal(self.data, self.key, compression, envelope))
+            sealed[len(sealed) // 2] ^= 1
+            with self.subTest(variant=name):
+                self.assertRejected(bytes(sealed))
+
+    def test_header_flags(self):
+        # Flags are bound to every record, clearing one can't change how
+        # the records are read
+        sealed = bytearray(seal(self.data, self.key, compressors.ZLIB))
+        sealed[len(container.MAGIC) + 1] &= ~container.FLAG_INDEX
+        self.assertRejected(bytes(sealed))
+
+
+if __name__ == "__main__":
+    unittest.main()